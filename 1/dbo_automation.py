@@ -9,26 +9,64 @@
 
 import os
 import time
+
+# Момент запуска процесса - для измерения времени до первой проверки
+PROCESS_START = time.perf_counter()
+
 import subprocess
 import platform
 import json
 import shutil
+import stat
+import shlex
+import errno
+import tarfile
+import argparse
+import hashlib
+import base64
+import importlib.util
+import functools
+import queue
+import socket
+import socketserver
+import random
+import tracemalloc
+from array import array
+from collections import deque, OrderedDict
 from pathlib import Path
 import logging
+import logging.handlers
 from datetime import datetime
 import threading
 
-try:
-    import paramiko
-    PARAMIKO_AVAILABLE = True
-except ImportError:
-    PARAMIKO_AVAILABLE = False
+# Тяжелые модули (paramiko, win32com) загружаются при первом использовании,
+# чтобы перезапуск после сбоя быстрее доходил до первой проверки
+PARAMIKO_AVAILABLE = importlib.util.find_spec('paramiko') is not None
+WIN32COM_AVAILABLE = importlib.util.find_spec('win32com') is not None
+PSUTIL_AVAILABLE = importlib.util.find_spec('psutil') is not None  # Необязателен, для --soak
+paramiko = None
+win32com = None
+
+
+def _load_paramiko():
+    """Отложенный импорт paramiko"""
+    global paramiko
+    if paramiko is None:
+        import paramiko
+    return paramiko
+
+
+def _load_win32com():
+    """Отложенный импорт win32com.client"""
+    global win32com
+    if win32com is None:
+        import win32com.client
+    return win32com
 
 try:
-    import win32com.client
-    WIN32COM_AVAILABLE = True
+    import fcntl  # Только Unix - нужен для reflink (FICLONE)
 except ImportError:
-    WIN32COM_AVAILABLE = False
+    fcntl = None
 
 # ============================================================================
 # КОНФИГУРАЦИЯ - ИЗМЕНИТЕ ПОД СВОИ НАСТРОЙКИ
@@ -51,6 +89,30 @@ SSH_PORT = 22  # SSH порт
 # Укажите полный путь к директории sent_attachments на удаленном сервере
 REMOTE_ATTACHMENTS_DIR = "/home/iux/mail/sent_attachments"  # Путь на удаленном сервере
 
+# Сколько страниц листинга удаленной директории запрашивать заранее (без ожидания ответа)
+SFTP_LISTING_READ_AHEAD = 50
+
+# Полосы передачи по SSH:
+#   малая полоса   - листинг и чтение метаданных, по ней вложения не скачиваются,
+#                    поэтому обнаружение новых писем не ждет больших файлов
+#   массовая полоса - скачивание вложений в отдельных SFTP-каналах,
+#                    очереди писем обслуживаются по кругу
+# Очередность - по файлам, а не по частям файла: начатый файл скачивается до конца.
+# Пока все BULK_LANE_WORKERS каналов заняты большими файлами (даже одного письма),
+# вложения других писем ждут. Увеличьте число каналов, если большие вложения часты.
+BULK_LANE_WORKERS = 2  # Количество параллельных SFTP-каналов для вложений
+# Ограничение скорости вложений (байт/сек), None - без ограничения.
+# При ограничении файл читается последовательными запросами по 32 КБ без упреждающего
+# чтения - каждый запрос отправляется только после паузы ограничителя.
+BULK_LANE_MAX_BYTES_PER_SEC = None
+
+# Пакетное скачивание: если у письма не меньше BULK_TAR_MIN_FILES вложений, удаленная
+# сторона отдает их одним tar-потоком через exec-канал (один запрос вместо двух на файл).
+# Файлы, не полученные из архива, скачиваются по одному через SFTP.
+BULK_TAR_ENABLED = True
+BULK_TAR_MIN_FILES = 3
+BULK_TAR_COMPRESS = False  # gzip-сжатие потока (имеет смысл для медленного канала)
+
 # ============================================================================
 # ЛОКАЛЬНЫЕ НАСТРОЙКИ (если USE_SSH = False)
 # ============================================================================
@@ -66,6 +128,19 @@ CONTAINER_ATTACHMENTS_DIR = os.path.join(
 USER_HOME = Path.home()
 DOWNLOAD_DIR = str(USER_HOME / "Downloads")
 
+# Директория для служебных файлов скрипта (трассировка, состояние)
+STATE_DIR = str(USER_HOME / ".dbo_automation")
+
+# Способы получения вложений в локальном режиме (пробуются по порядку):
+#   hardlink        - жесткая ссылка, данные не копируются (та же файловая система)
+#   reflink         - клонирование блоков файла (Btrfs/XFS, только Linux)
+#   copy_file_range - копирование внутри ядра (Linux)
+#   sendfile        - копирование внутри ядра через sendfile (Linux)
+#   copy            - обычное побайтовое копирование
+# Внимание: при hardlink скачанный файл и файл в контейнере - один и тот же файл.
+# Уберите "hardlink", если макросы могут изменять открываемый файл.
+LOCAL_MATERIALIZE_STRATEGIES = ("hardlink", "reflink", "copy_file_range", "sendfile", "copy")
+
 # Интервал проверки новых файлов (в секундах)
 CHECK_INTERVAL = 5
 
@@ -81,6 +156,57 @@ PROCESS_ALL_FILES = False
 # Время жизни скачанных файлов в минутах (после этого они удаляются)
 FILE_LIFETIME_MINUTES = 10
 
+# Сколько минут помнить обработанные файлы метаданных
+# Файлы старше этого окна (по mtime) больше не рассматриваются как новые,
+# поэтому индекс обработанных файлов не растет бесконечно
+PROCESSED_RETENTION_MINUTES = 60
+
+# Быстрый перезапуск: состояние (обработанные файлы, очередь, снимок директории,
+# скачанные файлы) периодически сохраняется и восстанавливается после перезапуска.
+# Состояние старше PROCESSED_RETENTION_MINUTES не используется (например, после перезагрузки ПК).
+STATE_ENABLED = True
+STATE_FILE = os.path.join(STATE_DIR, "state.json")
+STATE_SAVE_INTERVAL = 30  # Интервал сохранения состояния (в секундах)
+
+# Вывод содержимого директории контейнера при запуске:
+# "full" - до начала работы, "background" - в фоне, "off" - не выводить
+STARTUP_INVENTORY = "background"
+
+# Трассировка задержек по каждому письму:
+# mtime файла метаданных -> обнаружение -> скачивание -> открытие -> закрытие
+# Отчет: python dbo_automation.py --trace-report
+TRACE_ENABLED = True
+TRACE_FILE = os.path.join(STATE_DIR, "email_trace.tsv")
+
+# Локальный управляющий порт (слушает только 127.0.0.1) для внешних хуков:
+#   POLL            - немедленная проверка (сигналы объединяются в одну проверку)
+#   ENQUEUE <файл>  - обработать указанный файл *_metadata.json из отслеживаемой директории
+#   STATUS          - состояние автоматизации в JSON
+# Пример: python dbo_automation.py --control POLL
+CONTROL_ENABLED = True
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 47615
+# После сигнала проверка начинается, когда новые сигналы перестают приходить на
+# CONTROL_SETTLE сек (но не позже CONTROL_SETTLE_MAX сек) - пачка сигналов = одна проверка
+CONTROL_SETTLE = 0.1
+CONTROL_SETTLE_MAX = 0.5
+
+# Длительный прогон (--soak): периодический сбор показателей процесса (память по
+# местам выделения через tracemalloc, потоки, открытые файлы, SFTP-каналы, размеры
+# индексов) в ротируемый файл и предупреждения о росте показателей
+SOAK_LOG_FILE = os.path.join(STATE_DIR, "soak.log")
+SOAK_LOG_MAX_BYTES = 5 * 1024 * 1024
+SOAK_LOG_BACKUP_COUNT = 3
+SOAK_SAMPLE_INTERVAL = 60  # Интервал выборки (в секундах)
+SOAK_TOP_ALLOCATORS = 10  # Сколько мест выделения памяти записывать
+SOAK_TREND_WINDOW = 30  # По скольким последним выборкам оценивается рост
+
+# Синтетический прогон (--soak-synthetic DIR): генератор пишет письма в локальную
+# директорию, время ускорено в SOAK_SPEED раз (интервалы проверки, очистки и хранения
+# сокращаются), так что сутки трафика проходят за несколько минут
+SOAK_EMAILS_PER_HOUR = 120  # Интенсивность трафика в "реальном" времени
+SOAK_SPEED = 240  # Ускорение времени: сутки за 6 минут
+
 # ============================================================================
 # НАСТРОЙКА ЛОГИРОВАНИЯ
 # ============================================================================
@@ -99,6 +225,700 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# ============================================================================
+# КОМПАКТНОЕ ХРАНЕНИЕ СОСТОЯНИЯ
+# ============================================================================
+
+class ProcessedKeyIndex:
+    """Индекс обработанных файлов метаданных с водяной меткой по mtime
+
+    Вместо полных путей хранятся 64-битные хэши ключей с последним увиденным
+    временем модификации файла. Файлы с mtime старше водяной метки отсекаются при
+    поиске новых писем, поэтому их ключи можно удалять из индекса без риска
+    повторной обработки. Если файл перезаписан после обработки, touch() поднимает
+    его mtime, и ключ не удаляется, пока файл виден с новым mtime.
+    """
+
+    __slots__ = ('watermark', '_keys', '_lock')
+
+    def __init__(self, watermark):
+        """Инициализация индекса с начальной водяной меткой (timestamp)"""
+        self.watermark = watermark
+        self._keys = {}  # {хэш ключа: mtime}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(key):
+        """64-битный хэш ключа"""
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def __contains__(self, key):
+        return self._hash(key) in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_stale(self, mtime):
+        """Файл старше водяной метки - не рассматривается как новый"""
+        return mtime < self.watermark
+
+    def add(self, key, mtime):
+        """Пометка файла как обработанного"""
+        key_hash = self._hash(key)
+        with self._lock:
+            if mtime > self._keys.get(key_hash, float('-inf')):
+                self._keys[key_hash] = mtime
+
+    def touch(self, key, mtime):
+        """Проверка, обработан ли файл; для обработанного - запоминается увиденный mtime
+
+        Возвращает True, если файл уже обработан.
+        """
+        key_hash = self._hash(key)
+        with self._lock:
+            stored = self._keys.get(key_hash)
+            if stored is None:
+                return False
+            if mtime > stored:
+                self._keys[key_hash] = mtime
+            return True
+
+    def prune(self, watermark):
+        """Сдвиг водяной метки вперед и удаление ключей старше нее"""
+        with self._lock:
+            if watermark <= self.watermark:
+                return 0
+            self.watermark = watermark
+            keys = {key_hash: mtime for key_hash, mtime in self._keys.items() if mtime >= watermark}
+            removed = len(self._keys) - len(keys)
+            self._keys = keys
+            return removed
+
+    def to_state(self):
+        """Состояние индекса для сохранения на диск"""
+        with self._lock:
+            hashes = array('Q', self._keys.keys())
+            mtimes = array('d', self._keys.values())
+            watermark = self.watermark
+        return {
+            'watermark': watermark,
+            'hashes': base64.b64encode(hashes.tobytes()).decode('ascii'),
+            'mtimes': base64.b64encode(mtimes.tobytes()).decode('ascii'),
+        }
+
+    def load_state(self, state):
+        """Восстановление индекса из сохраненного состояния"""
+        hashes = array('Q')
+        mtimes = array('d')
+        hashes.frombytes(base64.b64decode(state['hashes']))
+        mtimes.frombytes(base64.b64decode(state['mtimes']))
+        if len(hashes) != len(mtimes):
+            raise ValueError("поврежденный индекс обработанных файлов")
+        with self._lock:
+            self.watermark = state['watermark']
+            self._keys = dict(zip(hashes, mtimes))
+
+
+class _DownloadRecord:
+    """Запись о скачанном файле"""
+
+    __slots__ = ('path', 'time')
+
+    def __init__(self, path, download_time):
+        self.path = path
+        self.time = download_time
+
+
+class DownloadedFilesLedger:
+    """Очередь скачанных файлов в порядке скачивания для последующего удаления"""
+
+    __slots__ = ('_records', '_lock')
+
+    def __init__(self):
+        self._records = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, path, download_time):
+        """Регистрация скачанного файла (download_time - timestamp)"""
+        with self._lock:
+            self._records.append(_DownloadRecord(str(path), download_time))
+
+    def pop_expired(self, cutoff):
+        """Извлечение записей, скачанных не позже cutoff"""
+        expired = []
+        with self._lock:
+            while self._records and self._records[0].time <= cutoff:
+                expired.append(self._records.popleft())
+        return expired
+
+    def requeue(self, record):
+        """Возврат записи в очередь (например, если файл не удалось удалить)"""
+        with self._lock:
+            self._records.append(record)
+
+    def to_state(self):
+        """Состояние очереди для сохранения на диск"""
+        with self._lock:
+            return [[record.path, record.time] for record in self._records]
+
+    def load_state(self, state):
+        """Восстановление очереди из сохраненного состояния"""
+        with self._lock:
+            self._records = deque(_DownloadRecord(path, download_time) for path, download_time in state)
+
+class _SnapshotEntry:
+    """Файл метаданных в снимке директории"""
+
+    __slots__ = ('name', 'path', 'mtime', 'size')
+
+    def __init__(self, name, path, mtime, size):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+
+
+class DirectorySnapshot:
+    """Снимок локальной директории, читаемой за один проход os.scandir
+
+    Хранит имена всех файлов и закэшированные stat-данные файлов метаданных.
+    refresh() возвращает только добавленные или измененные файлы метаданных,
+    а проверки существования вложений выполняются по снимку в памяти.
+    """
+
+    __slots__ = ('directory', 'suffix', 'names', 'entries')
+
+    def __init__(self, directory, suffix='_metadata.json'):
+        """Инициализация пустого снимка"""
+        self.directory = str(directory)
+        self.suffix = suffix
+        self.names = frozenset()
+        self.entries = {}  # {имя файла метаданных: _SnapshotEntry}
+
+    def refresh(self):
+        """Повторное чтение директории; возвращает добавленные/измененные файлы метаданных"""
+        names = set()
+        entries = {}
+        changed = []
+        with os.scandir(self.directory) as iterator:
+            for dir_entry in iterator:
+                name = dir_entry.name
+                names.add(name)
+                if not name.endswith(self.suffix):
+                    continue
+                try:
+                    st = dir_entry.stat()
+                except FileNotFoundError:
+                    names.discard(name)  # Файл удален во время чтения директории
+                    continue
+                previous = self.entries.get(name)
+                if previous and previous.mtime == st.st_mtime and previous.size == st.st_size:
+                    entries[name] = previous
+                else:
+                    entry = _SnapshotEntry(name, dir_entry.path, st.st_mtime, st.st_size)
+                    entries[name] = entry
+                    changed.append(entry)
+        self.names = frozenset(names)
+        self.entries = entries
+        return changed
+
+    def __len__(self):
+        return len(self.names)
+
+    def to_state(self):
+        """Состояние снимка (только файлы метаданных) для сохранения на диск"""
+        return [[entry.name, entry.mtime, entry.size] for entry in self.entries.values()]
+
+    def load_state(self, state):
+        """Восстановление снимка: при следующем refresh() вернутся только изменения"""
+        self.entries = {
+            name: _SnapshotEntry(name, os.path.join(self.directory, name), mtime, size)
+            for name, mtime, size in state
+        }
+        self.names = frozenset(self.entries)
+
+    def exists(self, name):
+        """Проверка существования файла по снимку (при промахе - проверка на диске)"""
+        if name in self.names:
+            return True
+        # Файл мог появиться после снимка
+        return os.path.exists(os.path.join(self.directory, name))
+
+# ============================================================================
+# ТРАССИРОВКА ЗАДЕРЖЕК ОБРАБОТКИ ПИСЕМ
+# ============================================================================
+
+# Этапы обработки письма в порядке прохождения
+TRACE_STAGES = ('mtime', 'detected', 'downloaded', 'launched', 'closed')
+
+
+class EmailLatencyTracer:
+    """Запись временных меток этапов обработки писем в append-only файл
+
+    Формат файла - по одной строке на событие: <id письма> TAB <этап> TAB <timestamp>
+    """
+
+    def __init__(self, trace_file):
+        """Инициализация трассировки"""
+        self.trace_file = Path(trace_file)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, trace_id, stage, timestamp=None):
+        """Запись события этапа обработки письма"""
+        if timestamp is None:
+            timestamp = time.time()
+        trace_id = str(trace_id).replace('\t', ' ').replace('\n', ' ')
+        try:
+            with self._lock:
+                if self._file is None:
+                    self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+                    self._file = open(self.trace_file, 'a', encoding='utf-8', buffering=1)
+                self._file.write(f"{trace_id}\t{stage}\t{timestamp:.3f}\n")
+        except Exception as e:
+            logger.debug(f"   Ошибка записи трассировки: {e}")
+
+    def close(self):
+        """Закрытие файла трассировки"""
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def _percentile(sorted_values, pct):
+    """Перцентиль методом ближайшего ранга (значения должны быть отсортированы)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def print_trace_report(trace_file, max_outliers=10):
+    """Отчет по задержкам этапов: p50/p95/p99 и письма-выбросы"""
+    trace_path = Path(trace_file)
+    if not trace_path.exists():
+        print(f"❌ Файл трассировки не найден: {trace_path}")
+        return
+    
+    # Для каждого письма берем первое наступление каждого этапа, для скачивания - последнее
+    # (в старых трассировках 'downloaded' писался для каждого вложения)
+    traces = {}
+    with open(trace_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                continue
+            trace_id, stage, timestamp = parts
+            try:
+                timestamp = float(timestamp)
+            except ValueError:
+                continue
+            stages = traces.setdefault(trace_id, {})
+            if stage not in stages:
+                stages[stage] = timestamp
+            elif stage == 'downloaded':
+                stages[stage] = max(stages[stage], timestamp)
+            else:
+                stages[stage] = min(stages[stage], timestamp)
+    
+    print("=" * 72)
+    print(f"ОТЧЕТ ПО ЗАДЕРЖКАМ ОБРАБОТКИ ПИСЕМ: {trace_path}")
+    print(f"Писем в трассировке: {len(traces)}")
+    print("=" * 72)
+    
+    tables = (
+        ("Задержка от mtime файла метаданных (сек)", lambda stages, i: stages[TRACE_STAGES[i]] - stages['mtime']),
+        ("Длительность этапа относительно предыдущего (сек)", lambda stages, i: stages[TRACE_STAGES[i]] - stages[TRACE_STAGES[i - 1]]),
+    )
+    for title, measure in tables:
+        print()
+        print(title)
+        print(f"{'Этап':<12}{'N':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        outliers = []
+        for i in range(1, len(TRACE_STAGES)):
+            stage = TRACE_STAGES[i]
+            samples = []
+            for trace_id, stages in traces.items():
+                try:
+                    samples.append((measure(stages, i), trace_id))
+                except KeyError:
+                    continue  # Этап (или предыдущий) не был достигнут
+            if not samples:
+                print(f"{stage:<12}{0:>7}{'-':>10}{'-':>10}{'-':>10}{'-':>10}")
+                continue
+            values = sorted(value for value, _ in samples)
+            p50 = _percentile(values, 50)
+            p95 = _percentile(values, 95)
+            p99 = _percentile(values, 99)
+            print(f"{stage:<12}{len(values):>7}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}{values[-1]:>10.3f}")
+            
+            # Выбросы - по правилу Тьюки: выше Q3 + 3 * IQR
+            q1 = _percentile(values, 25)
+            q3 = _percentile(values, 75)
+            fence = q3 + 3 * (q3 - q1)
+            outliers.extend((value, stage, trace_id) for value, trace_id in samples if value > fence and value > p50)
+        
+        if outliers:
+            outliers.sort(reverse=True)
+            print(f"   ⚠ Выбросы (выше Q3 + 3*IQR): {len(outliers)}")
+            for value, stage, trace_id in outliers[:max_outliers]:
+                print(f"     {stage:<12}{value:>10.3f} сек  {trace_id}")
+
+# ============================================================================
+# МАТЕРИАЛИЗАЦИЯ ВЛОЖЕНИЙ В ЛОКАЛЬНОМ РЕЖИМЕ
+# ============================================================================
+
+# ioctl FICLONE из linux/fs.h
+_FICLONE = 0x40049409
+
+
+class StrategyUnavailable(Exception):
+    """Способ копирования не поддерживается на этой платформе"""
+
+
+def _write_exclusive(source, target, fill):
+    """Создание нового файла target и заполнение его через fill(src, dst)
+
+    Существующий файл не перезаписывается (FileExistsError). Если заполнение
+    не удалось, созданный здесь файл удаляется.
+    """
+    with open(source, 'rb') as src:
+        dst = open(target, 'xb')
+        try:
+            with dst:
+                fill(src, dst)
+        except BaseException:
+            try:
+                os.unlink(target)
+            except OSError:
+                pass
+            raise
+    shutil.copystat(source, target)
+
+
+def _copy_in_kernel(source, target, copy_chunk):
+    """Копирование через файловые дескрипторы с помощью copy_chunk(src_fd, dst_fd, offset, count)"""
+    def fill(src, dst):
+        remaining = os.fstat(src.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            copied = copy_chunk(src.fileno(), dst.fileno(), offset, remaining)
+            if copied == 0:
+                break
+            offset += copied
+            remaining -= copied
+        if remaining > 0:
+            raise OSError(f"скопировано не полностью, осталось {remaining} байт")
+    _write_exclusive(source, target, fill)
+
+
+def _materialize_hardlink(source, target):
+    """Жесткая ссылка на файл в контейнере"""
+    os.link(source, target)
+
+
+def _materialize_reflink(source, target):
+    """Клонирование блоков файла (copy-on-write)"""
+    if fcntl is None or platform.system() != "Linux":
+        raise StrategyUnavailable()
+    _write_exclusive(source, target, lambda src, dst: fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno()))
+
+
+def _materialize_copy_file_range(source, target):
+    """Копирование внутри ядра через copy_file_range"""
+    if not hasattr(os, 'copy_file_range'):
+        raise StrategyUnavailable()
+    _copy_in_kernel(source, target,
+                    lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count))
+
+
+def _materialize_sendfile(source, target):
+    """Копирование внутри ядра через sendfile"""
+    if not hasattr(os, 'sendfile') or platform.system() != "Linux":
+        raise StrategyUnavailable()
+    _copy_in_kernel(source, target,
+                    lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count))
+
+
+def _materialize_copy(source, target):
+    """Обычное побайтовое копирование"""
+    _write_exclusive(source, target, shutil.copyfileobj)
+
+
+MATERIALIZE_STRATEGIES = {
+    'hardlink': _materialize_hardlink,
+    'reflink': _materialize_reflink,
+    'copy_file_range': _materialize_copy_file_range,
+    'sendfile': _materialize_sendfile,
+    'copy': _materialize_copy,
+}
+
+
+# Ошибки, означающие, что способ не поддерживается для этой пары файловых систем
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS}
+
+# Способы, не сработавшие для пары устройств: {(st_dev источника, st_dev цели): {способ}}
+_unsupported_strategies = {}
+
+
+def materialize_file(source, target, strategies=LOCAL_MATERIALIZE_STRATEGIES):
+    """Получение файла target из source первым сработавшим способом
+
+    Возвращает название использованного способа. Если не сработал ни один
+    способ, пробрасывается последняя ошибка. Существующий target никогда не
+    перезаписывается: FileExistsError пробрасывается сразу, чтобы вызывающий
+    код выбрал другое имя. Частично созданный файл удаляет сам способ.
+    Способ, который не поддерживается для пары устройств (EXDEV, EOPNOTSUPP и т.п.),
+    запоминается и для следующих файлов с той же парой не пробуется.
+    """
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(os.path.abspath(target))).st_dev)
+    unsupported = _unsupported_strategies.setdefault(devices, set())
+    last_error = None
+    for name in strategies:
+        if name in unsupported:
+            continue
+        try:
+            MATERIALIZE_STRATEGIES[name](str(source), str(target))
+            return name
+        except StrategyUnavailable:
+            unsupported.add(name)
+            continue
+        except FileExistsError:
+            raise
+        except OSError as e:
+            last_error = e
+            # Побайтовое копирование - последний вариант, его не исключаем
+            if e.errno in _UNSUPPORTED_ERRNOS and name != 'copy':
+                unsupported.add(name)
+                logger.debug(f"   Способ {name} не поддерживается для этих файловых систем - больше не используется: {e}")
+            else:
+                logger.debug(f"   Способ {name} не сработал для {Path(source).name}: {e}")
+    if last_error is None:
+        last_error = OSError("нет доступных способов копирования")
+    raise last_error
+
+# ============================================================================
+# ЛОКАЛЬНЫЙ УПРАВЛЯЮЩИЙ ПОРТ
+# ============================================================================
+
+class _ControlRequestHandler(socketserver.StreamRequestHandler):
+    """Обработка команд управляющего порта (по одной команде на строку)"""
+
+    def handle(self):
+        while True:
+            raw = self.rfile.readline(4096)
+            if not raw:
+                break
+            line = raw.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            response = self.server.automation.handle_control_command(line)
+            self.wfile.write((response + "\n").encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingTCPServer):
+    """TCP-сервер управляющих команд на localhost"""
+
+    daemon_threads = True
+
+    def __init__(self, automation, host, port):
+        """Инициализация сервера (порт открывается сразу)"""
+        super().__init__((host, port), _ControlRequestHandler)
+        self.automation = automation
+
+    def start(self):
+        """Запуск обработки команд в фоновом потоке"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """Остановка сервера"""
+        self.shutdown()
+        self.server_close()
+
+
+def send_control_command(command, host=CONTROL_HOST, port=CONTROL_PORT, timeout=5):
+    """Отправка команды запущенной автоматизации; возвращает ответ"""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        sock.sendall((command.strip() + "\n").encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    return response.decode('utf-8').strip()
+
+def stream_in_background(generator_factory):
+    """Выполнение генератора в фоновом потоке с выдачей элементов по мере готовности
+
+    Ошибка в фоновом потоке пробрасывается в вызывающий код.
+    """
+    items = queue.Queue()
+    finished = object()
+    errors = []
+    
+    def produce():
+        try:
+            for item in generator_factory():
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(finished)
+    
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is finished:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+# ============================================================================
+# ПОЛОСЫ ПЕРЕДАЧИ ПО SSH
+# ============================================================================
+
+class BandwidthLimiter:
+    """Ограничение скорости передачи (token bucket), общее для всех потоков"""
+
+    def __init__(self, bytes_per_sec=None):
+        """Инициализация ограничителя (None - без ограничения)"""
+        self.rate = bytes_per_sec
+        self._allowance = bytes_per_sec or 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Учет переданных байт; при превышении скорости - пауза"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= nbytes
+            delay = -self._allowance / self.rate if self._allowance < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BulkTransferLane:
+    """Массовая полоса передачи вложений
+
+    Задания выполняются рабочими потоками, у каждого свой SFTP-канал, так что
+    основной канал (листинг, метаданные) никогда не занят большими файлами.
+    Очереди заданий ведутся по письмам и обслуживаются по кругу, чтобы одно
+    письмо с большими вложениями не задерживало остальные. Очередность - по
+    заданиям (файлам): начатое задание выполняется до конца. Задание - функция
+    job(sftp), возвращающая путь скачанного файла, список путей или None.
+    """
+
+    def __init__(self, ssh, workers=2, max_bytes_per_sec=None):
+        """Инициализация полосы (потоки запускаются при первом задании)"""
+        self.ssh = ssh
+        self.workers = max(1, workers)
+        self.limiter = BandwidthLimiter(max_bytes_per_sec)
+        self._queues = OrderedDict()  # {ключ письма: deque(заданий)}
+        self._batches = {}  # {ключ письма: [осталось заданий, результаты, on_done]}
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+    def pending(self):
+        """Количество писем, вложения которых еще скачиваются"""
+        with self._cond:
+            return len(self._batches)
+
+    def submit(self, email_key, jobs, on_done):
+        """Постановка заданий письма в очередь; on_done(результаты) вызывается после всех заданий"""
+        with self._cond:
+            if not self._threads:
+                self._start()
+            batch = self._batches.setdefault(email_key, [0, [], on_done])
+            batch[0] += len(jobs)
+            self._queues.setdefault(email_key, deque()).extend(jobs)
+            self._cond.notify_all()
+
+    def stop(self):
+        """Остановка рабочих потоков (незавершенные задания отбрасываются)"""
+        with self._cond:
+            self._stopping = True
+            self._queues.clear()
+            self._batches.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def _start(self):
+        """Запуск рабочих потоков"""
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"bulk-lane-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """Выбор следующего задания по кругу между письмами (вызывается под блокировкой)"""
+        email_key, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._queues.move_to_end(email_key)
+        else:
+            del self._queues[email_key]
+        return email_key, job
+
+    def _worker(self):
+        """Рабочий поток массовой полосы"""
+        sftp = None
+        while True:
+            with self._cond:
+                while not self._queues and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    break
+                email_key, job = self._next_job()
+            
+            result = None
+            try:
+                # Канал мог закрыться (например, после переподключения) - открываем новый
+                if sftp is None or sftp.sock.closed:
+                    sftp = self.ssh.client.open_sftp()
+                result = job(sftp)
+            except Exception as e:
+                logger.error(f"❌ Ошибка в полосе передачи вложений: {e}")
+                sftp = None
+            self._job_done(email_key, result)
+        
+        if sftp is not None:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+
+    def _job_done(self, email_key, result):
+        """Учет результата задания; после последнего задания письма - вызов on_done"""
+        with self._cond:
+            batch = self._batches.get(email_key)
+            if batch is None:
+                return  # Полоса остановлена
+            if isinstance(result, list):
+                batch[1].extend(result)
+            elif result is not None:
+                batch[1].append(result)
+            batch[0] -= 1
+            if batch[0] > 0:
+                return
+            del self._batches[email_key]
+        batch[2](batch[1])
+
 # ============================================================================
 # КЛАСС SSH ПОДКЛЮЧЕНИЯ
 # ============================================================================
@@ -114,6 +934,8 @@ class SSHConnection:
         self.port = port
         self.client = None
         self.sftp = None
+        self.listing_sftp = None  # Отдельный SFTP-канал для потокового листинга
+        self._listing_lock = threading.Lock()
         self.is_connected = False
     
     def connect(self):
@@ -126,6 +948,7 @@ class SSHConnection:
             logger.info(f"🔗 Подключение к SSH серверу...")
             logger.info(f"   SSH: {self.user}@{self.host}:{self.port}")
             
+            _load_paramiko()
             self.client = paramiko.SSHClient()
             self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             
@@ -145,17 +968,20 @@ class SSHConnection:
             logger.info(f"✓ SSH подключение установлено")
             return True
             
-        except paramiko.AuthenticationException:
-            logger.error(f"❌ Ошибка аутентификации SSH")
-            logger.error(f"   Проверьте правильность пароля")
-            return False
         except Exception as e:
-            logger.error(f"❌ Ошибка подключения к SSH: {e}")
+            if paramiko is not None and isinstance(e, paramiko.AuthenticationException):
+                logger.error(f"❌ Ошибка аутентификации SSH")
+                logger.error(f"   Проверьте правильность пароля")
+            else:
+                logger.error(f"❌ Ошибка подключения к SSH: {e}")
             return False
     
     def disconnect(self):
         """Отключение от SSH сервера"""
         try:
+            if self.listing_sftp:
+                self.listing_sftp.close()
+                self.listing_sftp = None
             if self.sftp:
                 self.sftp.close()
                 self.sftp = None
@@ -167,41 +993,123 @@ class SSHConnection:
         except:
             pass
     
-    def list_files(self, remote_dir):
-        """Получение списка файлов в удаленной директории"""
-        try:
-            if not self.is_connected:
-                return []
-            
-            files = []
+    def iter_files(self, remote_dir, read_aheads=SFTP_LISTING_READ_AHEAD):
+        """Потоковое получение списка файлов в удаленной директории
+
+        Страницы директории запрашиваются с упреждением (read_aheads запросов
+        в полете), записи выдаются по мере получения. Листинг идет по отдельному
+        SFTP-каналу, чтобы не мешать остальным запросам.
+        """
+        if not self.is_connected:
+            return
+        
+        with self._listing_lock:
             try:
-                for item in self.sftp.listdir_attr(remote_dir):
-                    files.append({
+                if self.listing_sftp is None:
+                    self.listing_sftp = self.client.open_sftp()
+                for item in self._listdir_read_ahead(self.listing_sftp, remote_dir, read_aheads):
+                    yield {
                         'name': item.filename,
                         'size': item.st_size,
                         'mtime': item.st_mtime
-                    })
+                    }
             except FileNotFoundError:
                 logger.warning(f"⚠ Директория не найдена на удаленном сервере: {remote_dir}")
-                return []
-            
-            return files
-        except Exception as e:
-            logger.error(f"❌ Ошибка при получении списка файлов: {e}")
-            return []
+            except Exception as e:
+                logger.error(f"❌ Ошибка при получении списка файлов: {e}")
+                # Канал мог остаться в неопределенном состоянии - откроем новый
+                try:
+                    self.listing_sftp.close()
+                except Exception:
+                    pass
+                self.listing_sftp = None
+    
+    @staticmethod
+    def _listdir_read_ahead(sftp, remote_dir, read_aheads):
+        """Чтение директории с упреждающими READDIR-запросами
+
+        В отличие от SFTPClient.listdir_iter, ответы читаются через _read_response,
+        поэтому номера запросов удаляются из sftp._expecting, и долгоживущий канал
+        листинга не накапливает их от проверки к проверке. Ответы на запросы,
+        оставшиеся в полете (конец директории, прерванный перебор), дочитываются.
+        """
+        ssh_lib = _load_paramiko()
+        sftp_protocol = ssh_lib.sftp
+        t, msg = sftp._request(sftp_protocol.CMD_OPENDIR, sftp._adjust_cwd(remote_dir))
+        if t != sftp_protocol.CMD_HANDLE:
+            raise ssh_lib.SFTPError("Expected handle")
+        handle = msg.get_string()
+        
+        pending = deque(sftp._async_request(type(None), sftp_protocol.CMD_READDIR, handle)
+                        for _ in range(max(1, read_aheads)))
+        try:
+            end_of_directory = False
+            while pending:
+                try:
+                    t, msg = sftp._read_response(pending.popleft())
+                except EOFError:
+                    end_of_directory = True  # Остальные ответы в полете - тоже конец директории
+                    continue
+                if end_of_directory:
+                    continue
+                if t != sftp_protocol.CMD_NAME:
+                    raise ssh_lib.SFTPError("Expected name response")
+                for _ in range(msg.get_int()):
+                    filename = msg.get_text()
+                    longname = msg.get_text()
+                    attr = ssh_lib.SFTPAttributes._from_msg(msg, filename, longname)
+                    if filename not in ('.', '..'):
+                        yield attr
+                pending.append(sftp._async_request(type(None), sftp_protocol.CMD_READDIR, handle))
+        finally:
+            # Дочитываем ответы, чтобы они не остались в _expecting
+            while pending:
+                try:
+                    sftp._read_response(pending.popleft())
+                except Exception:
+                    pass
+            sftp._request(sftp_protocol.CMD_CLOSE, handle)
+    
+    def list_files(self, remote_dir):
+        """Получение списка файлов в удаленной директории"""
+        return list(self.iter_files(remote_dir))
     
-    def download_file(self, remote_path, local_path):
-        """Скачивание файла с удаленного сервера"""
+    def download_file(self, remote_path, local_path, sftp=None, limiter=None):
+        """Скачивание файла с удаленного сервера
+
+        sftp - канал для скачивания (по умолчанию основной),
+        limiter - ограничитель скорости BandwidthLimiter.
+        """
         try:
             if not self.is_connected:
                 return False
             
-            self.sftp.get(remote_path, local_path)
+            sftp = sftp or self.sftp
+            if limiter is None or not limiter.rate:
+                sftp.get(remote_path, local_path)
+                return True
+            
+            # Скачивание с ограничением скорости: без prefetch() (он запрашивает весь файл
+            # сразу, и данные идут на полной скорости в память), один запрос на чтение
+            # за раз, разрешение ограничителя - до отправки запроса
+            with sftp.open(remote_path, 'rb') as remote_file, open(local_path, 'wb') as local_file:
+                while True:
+                    limiter.consume(32768)
+                    chunk = remote_file.read(32768)
+                    if not chunk:
+                        break
+                    local_file.write(chunk)
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка при скачивании файла {remote_path}: {e}")
             return False
     
+    def exec_stream(self, command, timeout=60):
+        """Выполнение команды на удаленном сервере; возвращает потоки (stdout, stderr)"""
+        stdin, stdout, stderr = self.client.exec_command(command, timeout=timeout)
+        stdin.close()
+        return stdout, stderr
+    
     def read_file(self, remote_path):
         """Чтение содержимого файла с удаленного сервера"""
         try:
@@ -223,20 +1131,59 @@ class DBOOperatorAutomation:
     
     def __init__(self, container_dir=None, download_dir="downloaded_attachments", 
                  process_all=False, use_ssh=False, ssh_host=None, ssh_user=None, 
-                 ssh_password=None, ssh_port=22, remote_dir=None):
+                 ssh_password=None, ssh_port=22, remote_dir=None, trace_file=None,
+                 control_port=None, state_file=None):
         """Инициализация автоматизации"""
         self.use_ssh = use_ssh
         self.download_dir = Path(download_dir)
         self.download_dir.mkdir(parents=True, exist_ok=True)
         self.process_all = process_all
-        self.processed_files = set()
         self.start_time = datetime.now()  # Время запуска скрипта для фильтрации старых файлов
-        self.downloaded_files_times = {}  # {file_path: download_time} для отслеживания времени скачивания
+        # Обработанные файлы метаданных; водяная метка - время запуска скрипта
+        self.processed_files = ProcessedKeyIndex(self.start_time.timestamp())
+        # Скачанные файлы в порядке скачивания для последующего удаления
+        self.downloaded_files_times = DownloadedFilesLedger()
+        # Письма, вложения которых еще скачиваются ({путь файла метаданных})
+        self._in_flight = set()
+        # Сколько раз использован каждый способ получения вложений (локальный режим)
+        self.materialize_stats = {}
+        # Трассировка задержек обработки писем (None - отключена)
+        self.tracer = EmailLatencyTracer(trace_file) if trace_file else None
+        
+        # Управляющий порт: внеочередные проверки и очередь файлов метаданных
+        self.control_port = control_port
+        self.control_server = None
+        self._wake = threading.Event()  # Несколько сигналов до проверки = одна проверка
+        self._enqueued = deque()
+        self._control_lock = threading.Lock()
+        self.poll_count = 0
+        self.last_poll_time = None
+        
+        # Сохранение состояния для быстрого перезапуска (None - отключено)
+        self.state_file = Path(state_file) if state_file else None
+        # Журнал писем, обработанных после последнего сохранения состояния. Ключ пишется
+        # до открытия .xlsm, поэтому после сбоя письмо не обрабатывается повторно
+        self.journal_file = self.state_file.with_suffix('.journal') if self.state_file else None
+        self._journal_lock = threading.Lock()
+        self.time_to_first_poll = None
+        
+        # Периодическое обслуживание (синтетический прогон сокращает интервалы)
+        self.cleanup_interval_minutes = 5
+        self.file_lifetime_minutes = FILE_LIFETIME_MINUTES
+        self.processed_retention_minutes = PROCESSED_RETENTION_MINUTES
+        # Профилировщик длительного прогона (None - отключен)
+        self.profiler = None
+        self._stop = threading.Event()
         
         if use_ssh:
             self.ssh = SSHConnection(ssh_host, ssh_user, ssh_password, ssh_port)
             self.remote_dir = remote_dir
             self.container_dir = None
+            self.snapshot = None
+            # Статистика последнего листинга удаленной директории
+            self.listing_stats = {'total': 0, 'metadata': 0, 'metadata_examples': []}
+            # Вложения скачиваются в массовой полосе, не задерживая опрос
+            self.bulk_lane = BulkTransferLane(self.ssh, BULK_LANE_WORKERS, BULK_LANE_MAX_BYTES_PER_SEC)
             logger.info(f"Инициализация автоматизации (SSH режим)")
             logger.info(f"SSH сервер: {ssh_user}@{ssh_host}:{ssh_port}")
             logger.info(f"Удаленная директория: {remote_dir}")
@@ -244,6 +1191,11 @@ class DBOOperatorAutomation:
             self.ssh = None
             self.remote_dir = None
             self.container_dir = Path(container_dir) if container_dir else None
+            self.bulk_lane = None
+            # Снимок директории контейнера, обновляется один раз за проверку
+            self.snapshot = DirectorySnapshot(self.container_dir) if self.container_dir else None
+            # Файлы метаданных, найденные ранее, но еще не обработанные (повторяем попытку)
+            self._pending_metadata = set()
             logger.info(f"Инициализация автоматизации (локальный режим)")
             if self.container_dir:
                 logger.info(f"Директория контейнера: {self.container_dir}")
@@ -260,10 +1212,13 @@ class DBOOperatorAutomation:
             if not self.ssh.is_connected:
                 if not self.ssh.connect():
                     return False
-            # Проверяем доступность удаленной директории
+            # Проверяем доступность удаленной директории (stat, без чтения содержимого -
+            # большая директория не задерживает первую проверку)
             try:
-                self.ssh.sftp.listdir(self.remote_dir)
-                return True
+                if stat.S_ISDIR(self.ssh.sftp.stat(self.remote_dir).st_mode or 0):
+                    return True
+                logger.warning(f"⚠ Удаленный путь не является директорией: {self.remote_dir}")
+                return False
             except:
                 logger.warning(f"⚠ Удаленная директория не найдена: {self.remote_dir}")
                 return False
@@ -275,92 +1230,310 @@ class DBOOperatorAutomation:
             return True
     
     def get_new_metadata_files(self):
-        """Получение списка новых JSON файлов с метаданными"""
+        """Получение списка новых JSON файлов с метаданными (локальный режим)
+
+        В SSH режиме новые файлы перебираются потоково - см. _iter_remote_metadata_files.
+        """
         try:
-            if self.use_ssh:
-                if not self.ssh.is_connected:
-                    return []
-                
-                # Получаем список файлов через SSH
-                all_files_info = self.ssh.list_files(self.remote_dir)
-                all_files = [f['name'] for f in all_files_info]
-                
-                logger.debug(f"   Всего файлов в директории: {len(all_files)}")
-                if all_files:
-                    logger.debug(f"   Примеры файлов: {all_files[:5]}")
-                
-                metadata_files = []
-                for file_info in all_files_info:
-                    filename = file_info['name']
-                    if filename.endswith('_metadata.json'):
-                        # Проверяем время модификации файла - только файлы после запуска
-                        file_mtime = datetime.fromtimestamp(file_info['mtime'])
-                        if file_mtime < self.start_time:
-                            logger.debug(f"   Пропущен старый файл: {filename} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
-                            continue
-                        
-                        file_key = f"{self.remote_dir}/{filename}"
-                        if self.process_all or file_key not in self.processed_files:
-                            metadata_files.append({
-                                'name': filename,
-                                'path': f"{self.remote_dir}/{filename}",
-                                'remote': True,
-                                'mtime': file_mtime
-                            })
-                            logger.debug(f"   Найден новый файл метаданных: {filename} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
-                        else:
-                            logger.debug(f"   Файл уже обработан: {filename}")
-                
-                # Если нет метаданных, но есть другие файлы, показываем предупреждение
-                if not metadata_files and all_files:
-                    non_metadata = [f for f in all_files if not f.endswith('_metadata.json')]
-                    if non_metadata:
-                        logger.warning(f"   ⚠ Найдены файлы без метаданных: {len(non_metadata)} файл(ов)")
-                        logger.info(f"   Убедитесь, что контейнер создает файлы *_metadata.json")
-                
-                return sorted(metadata_files, key=lambda x: x['name'])
+            if self.snapshot is None:
+                return []
+            
+            # Один проход по директории: имена всех файлов и stat файлов метаданных
+            try:
+                changed = self.snapshot.refresh()
+            except FileNotFoundError:
+                return []
+            logger.debug(f"   Всего файлов в директории: {len(self.snapshot)}")
+            
+            # Рассматриваем только новые/измененные файлы и ранее не обработанные
+            if self.process_all:
+                candidates = list(self.snapshot.entries.values())
             else:
-                if not self.container_dir or not self.container_dir.exists():
-                    return []
-                
-                # Показываем все файлы в директории для отладки
-                all_files = list(self.container_dir.iterdir())
-                logger.debug(f"   Всего файлов в директории: {len(all_files)}")
-                if all_files:
-                    logger.debug(f"   Примеры файлов: {[f.name for f in all_files[:5]]}")
-                
-                metadata_files = []
-                for file_path in self.container_dir.glob("*_metadata.json"):
-                    # Проверяем время модификации файла - только файлы после запуска
-                    file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                    if file_mtime < self.start_time:
-                        logger.debug(f"   Пропущен старый файл: {file_path.name} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
-                        continue
-                    
-                    file_str = str(file_path)
-                    if self.process_all or file_str not in self.processed_files:
-                        metadata_files.append({
-                            'name': file_path.name,
-                            'path': str(file_path),
-                            'remote': False,
-                            'mtime': file_mtime
-                        })
-                        logger.debug(f"   Найден новый файл метаданных: {file_path.name} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+                candidates = {entry.name: entry for entry in changed}
+                for name in list(self._pending_metadata):
+                    entry = self.snapshot.entries.get(name)
+                    if entry:
+                        candidates.setdefault(name, entry)
                     else:
-                        logger.debug(f"   Файл уже обработан: {file_path.name}")
-                
-                # Если нет метаданных, но есть другие файлы, показываем предупреждение
-                if not metadata_files and all_files:
-                    non_metadata = [f for f in all_files if not f.name.endswith('_metadata.json')]
-                    if non_metadata:
-                        logger.warning(f"   ⚠ Найдены файлы без метаданных: {len(non_metadata)} файл(ов)")
-                        logger.info(f"   Убедитесь, что контейнер создает файлы *_metadata.json")
+                        self._pending_metadata.discard(name)
+                candidates = list(candidates.values())
+            
+            metadata_files = []
+            for entry in candidates:
+                # Проверяем время модификации файла - только файлы новее водяной метки
+                file_mtime = datetime.fromtimestamp(entry.mtime)
+                if self.processed_files.is_stale(entry.mtime):
+                    self._pending_metadata.discard(entry.name)
+                    logger.debug(f"   Пропущен старый файл: {entry.name} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+                    continue
                 
-                return sorted(metadata_files, key=lambda x: x['name'])
+                if self.process_all or not self.processed_files.touch(entry.path, entry.mtime):
+                    metadata_files.append({
+                        'name': entry.name,
+                        'path': entry.path,
+                        'remote': False,
+                        'mtime': file_mtime
+                    })
+                    self._pending_metadata.add(entry.name)
+                    self.trace(entry.name, 'mtime', entry.mtime)
+                    self.trace(entry.name, 'detected')
+                    logger.debug(f"   Найден новый файл метаданных: {entry.name} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+                else:
+                    self._pending_metadata.discard(entry.name)
+                    logger.debug(f"   Файл уже обработан: {entry.name}")
+            
+            # Если файлов метаданных нет совсем, но есть другие файлы, показываем предупреждение
+            # (вложения уже обработанных писем - не повод для предупреждения)
+            non_metadata_count = len(self.snapshot) - len(self.snapshot.entries)
+            if not self.snapshot.entries and non_metadata_count:
+                logger.warning(f"   ⚠ Найдены файлы без метаданных: {non_metadata_count} файл(ов)")
+                logger.info(f"   Убедитесь, что контейнер создает файлы *_metadata.json")
+            
+            return sorted(metadata_files, key=lambda x: x['name'])
         except Exception as e:
             logger.error(f"❌ Ошибка при получении списка файлов: {e}")
             return []
     
+    def _iter_remote_metadata_files(self):
+        """Потоковый поиск новых файлов метаданных на удаленном сервере
+
+        Записи фильтруются по мере получения страниц листинга; статистика
+        директории накапливается в self.listing_stats.
+        """
+        stats = {'total': 0, 'metadata': 0, 'metadata_examples': []}
+        self.listing_stats = stats
+        
+        for file_info in self.ssh.iter_files(self.remote_dir):
+            stats['total'] += 1
+            filename = file_info['name']
+            if not filename.endswith('_metadata.json'):
+                continue
+            stats['metadata'] += 1
+            if len(stats['metadata_examples']) < 3:
+                stats['metadata_examples'].append(filename)
+            
+            # Проверяем время модификации файла - только файлы новее водяной метки
+            file_mtime = datetime.fromtimestamp(file_info['mtime'])
+            if self.processed_files.is_stale(file_info['mtime']):
+                logger.debug(f"   Пропущен старый файл: {filename} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+                continue
+            
+            file_key = f"{self.remote_dir}/{filename}"
+            if file_key in self._in_flight:
+                logger.debug(f"   Вложения письма еще скачиваются: {filename}")
+                continue
+            if self.process_all or not self.processed_files.touch(file_key, file_info['mtime']):
+                self.trace(filename, 'mtime', file_info['mtime'])
+                self.trace(filename, 'detected')
+                logger.debug(f"   Найден новый файл метаданных: {filename} (создан: {file_mtime.strftime('%Y-%m-%d %H:%M:%S')})")
+                yield {
+                    'name': filename,
+                    'path': file_key,
+                    'remote': True,
+                    'mtime': file_mtime
+                }
+            else:
+                logger.debug(f"   Файл уже обработан: {filename}")
+    
+    def trace(self, trace_id, stage, timestamp=None):
+        """Запись этапа обработки письма в трассировку (если включена)"""
+        if self.tracer and trace_id:
+            self.tracer.record(trace_id, stage, timestamp)
+    
+    def request_poll(self):
+        """Запрос немедленной проверки (повторные запросы объединяются)"""
+        self._wake.set()
+    
+    def enqueue_metadata(self, path):
+        """Постановка файла метаданных в очередь на обработку при ближайшей проверке"""
+        # Берем только имя файла - обрабатываются только файлы отслеживаемой директории
+        name = path.replace('\\', '/').rstrip('/').rsplit('/', 1)[-1]
+        if not name.endswith('_metadata.json'):
+            return False
+        with self._control_lock:
+            self._enqueued.append(name)
+        self.request_poll()
+        return True
+    
+    def get_status(self):
+        """Состояние автоматизации для команды STATUS"""
+        with self._control_lock:
+            enqueued = len(self._enqueued)
+        return {
+            'mode': 'ssh' if self.use_ssh else 'local',
+            'connected': bool(self.ssh and self.ssh.is_connected) if self.use_ssh else None,
+            'poll_count': self.poll_count,
+            'last_poll_time': self.last_poll_time.strftime('%Y-%m-%d %H:%M:%S') if self.last_poll_time else None,
+            'enqueued': enqueued,
+            'processed_keys': len(self.processed_files),
+            'watermark': datetime.fromtimestamp(self.processed_files.watermark).strftime('%Y-%m-%d %H:%M:%S'),
+            'downloaded_files': len(self.downloaded_files_times),
+            'emails_downloading': len(self._in_flight),
+            'materialize_stats': dict(self.materialize_stats),
+            'time_to_first_poll': self.time_to_first_poll,
+            'soak': self.profiler.last_sample_summary() if self.profiler else None,
+        }
+    
+    def handle_control_command(self, line):
+        """Выполнение команды управляющего порта; возвращает строку ответа"""
+        command, _, argument = line.partition(' ')
+        command = command.upper()
+        argument = argument.strip()
+        if command == 'POLL':
+            self.request_poll()
+            return "OK"
+        if command == 'ENQUEUE':
+            if not argument:
+                return "ERROR не указан файл метаданных"
+            if not self.enqueue_metadata(argument):
+                return "ERROR ожидается файл *_metadata.json"
+            logger.info(f"📥 Файл поставлен в очередь через управляющий порт: {argument}")
+            return "OK"
+        if command == 'STATUS':
+            return json.dumps(self.get_status(), ensure_ascii=False)
+        return f"ERROR неизвестная команда: {command}"
+    
+    def _settle_wake(self):
+        """Ожидание конца пачки сигналов: тишина CONTROL_SETTLE сек, не дольше CONTROL_SETTLE_MAX"""
+        deadline = time.monotonic() + CONTROL_SETTLE_MAX
+        while not self._stop.is_set():
+            self._wake.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._wake.wait(min(CONTROL_SETTLE, remaining)):
+                return
+    
+    def stop(self):
+        """Остановка непрерывной проверки после текущей проверки (из другого потока)"""
+        self._stop.set()
+        self._wake.set()
+    
+    def start_control_server(self):
+        """Запуск управляющего порта (если задан)"""
+        if not self.control_port:
+            return
+        try:
+            self.control_server = ControlServer(self, CONTROL_HOST, self.control_port)
+            self.control_server.start()
+            logger.info(f"🎛  Управляющий порт: {CONTROL_HOST}:{self.control_port}")
+        except OSError as e:
+            self.control_server = None
+            logger.warning(f"⚠ Не удалось открыть управляющий порт {CONTROL_HOST}:{self.control_port}: {e}")
+    
+    def stop_control_server(self):
+        """Остановка управляющего порта"""
+        if self.control_server:
+            self.control_server.stop()
+            self.control_server = None
+    
+    def _state_owner(self):
+        """Отслеживаемая директория, к которой относится сохраненное состояние"""
+        return f"ssh://{self.ssh.host}{self.remote_dir}" if self.use_ssh else str(self.container_dir)
+    
+    def save_state(self):
+        """Сохранение состояния на диск (атомарная замена файла)"""
+        if not self.state_file:
+            return
+        try:
+            with self._control_lock:
+                enqueued = list(self._enqueued)
+            # Под блокировкой журнала: пометки, сделанные во время сохранения,
+            # не потеряются при очистке журнала
+            with self._journal_lock:
+                state = {
+                    'version': 1,
+                    'saved_at': time.time(),
+                    'owner': self._state_owner(),
+                    'processed': self.processed_files.to_state(),
+                    'downloaded': self.downloaded_files_times.to_state(),
+                    'enqueued': enqueued,
+                }
+                if self.snapshot is not None:
+                    state['snapshot'] = self.snapshot.to_state()
+                    state['pending'] = sorted(self._pending_metadata)
+                
+                self.state_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.replace(tmp_file, self.state_file)
+                
+                # Все записи журнала вошли в сохраненное состояние
+                if self.journal_file.exists():
+                    self.journal_file.unlink()
+        except Exception as e:
+            logger.warning(f"⚠ Не удалось сохранить состояние: {e}")
+    
+    def restore_state(self):
+        """Восстановление состояния после перезапуска"""
+        if not self.state_file or not self.state_file.exists():
+            return False
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            
+            age_minutes = (time.time() - state['saved_at']) / 60
+            if state.get('version') != 1 or state.get('owner') != self._state_owner():
+                logger.info("   Сохраненное состояние относится к другой директории - не используется")
+                return False
+            if age_minutes > PROCESSED_RETENTION_MINUTES:
+                logger.info(f"   Сохраненное состояние устарело ({age_minutes:.0f} мин) - не используется")
+                return False
+            
+            self.processed_files.load_state(state['processed'])
+            replayed = self._replay_journal()
+            self.downloaded_files_times.load_state(state['downloaded'])
+            with self._control_lock:
+                self._enqueued.extend(state.get('enqueued', []))
+            if self.snapshot is not None and 'snapshot' in state:
+                self.snapshot.load_state(state['snapshot'])
+                self._pending_metadata.update(state.get('pending', []))
+            
+            logger.info(f"♻ Состояние восстановлено (сохранено {age_minutes:.1f} мин назад): "
+                        f"обработано {len(self.processed_files)} (из журнала: {replayed}), "
+                        f"скачанных файлов {len(self.downloaded_files_times)}")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠ Не удалось восстановить состояние: {e}")
+            return False
+    
+    def _take_enqueued_metadata_files(self):
+        """Извлечение файлов метаданных, поставленных в очередь через управляющий порт"""
+        with self._control_lock:
+            names = list(dict.fromkeys(self._enqueued))  # Без повторов, в порядке поступления
+            self._enqueued.clear()
+        
+        metadata_files = []
+        for name in names:
+            try:
+                if self.use_ssh:
+                    path = f"{self.remote_dir}/{name}"
+                    st_mtime = self.ssh.sftp.stat(path).st_mtime
+                else:
+                    path = str(self.container_dir / name)
+                    st_mtime = os.stat(path).st_mtime
+            except Exception as e:
+                logger.warning(f"   ⚠ Файл из очереди не найден: {name} ({e})")
+                continue
+            
+            if self.processed_files.is_stale(st_mtime) or (not self.process_all and self.processed_files.touch(path, st_mtime)):
+                logger.info(f"   Файл из очереди уже обработан: {name}")
+                continue
+            if path in self._in_flight:
+                logger.info(f"   Вложения письма из очереди уже скачиваются: {name}")
+                continue
+            
+            if not self.use_ssh:
+                self._pending_metadata.add(name)
+            self.trace(name, 'mtime', st_mtime)
+            self.trace(name, 'detected')
+            metadata_files.append({
+                'name': name,
+                'path': path,
+                'remote': self.use_ssh,
+                'mtime': datetime.fromtimestamp(st_mtime)
+            })
+        return metadata_files
+    
     def load_email_metadata(self, metadata_file_info):
         """Загрузка метаданных письма из JSON файла"""
         try:
@@ -378,43 +1551,72 @@ class DBOOperatorAutomation:
             logger.error(f"❌ Ошибка при загрузке метаданных {metadata_file_info.get('name', 'unknown')}: {e}")
             return None
     
-    def copy_attachment(self, source_file, target_filename, is_remote=False):
+    def _target_path_for(self, target_filename, reserve=False):
+        """Путь для сохранения файла в директории загрузки
+
+        Если файл уже существует, к имени добавляется номер. При reserve=True
+        имя резервируется созданием пустого файла - вложения скачиваются
+        параллельно, и два потока не должны выбрать одно и то же имя.
+        """
+        target_path = self.download_dir / target_filename
+        counter = 1
+        original_path = target_path
+        while True:
+            if reserve:
+                try:
+                    open(target_path, 'xb').close()
+                    return target_path
+                except FileExistsError:
+                    pass
+            elif not target_path.exists():
+                return target_path
+            stem = original_path.stem
+            suffix = original_path.suffix
+            target_path = self.download_dir / f"{stem}_{counter}{suffix}"
+            counter += 1
+    
+    def copy_attachment(self, source_file, target_filename, is_remote=False, sftp=None):
         """Копирование файла из контейнера в директорию загрузки"""
         try:
-            target_path = self.download_dir / target_filename
-            
             # Если файл уже существует, добавляем номер
-            counter = 1
-            original_path = target_path
-            while target_path.exists():
-                stem = original_path.stem
-                suffix = original_path.suffix
-                target_path = self.download_dir / f"{stem}_{counter}{suffix}"
-                counter += 1
+            target_path = self._target_path_for(target_filename, reserve=is_remote)
             
             if is_remote:
                 # Скачиваем с удаленного сервера через SFTP
-                if self.ssh.download_file(source_file, str(target_path)):
+                limiter = self.bulk_lane.limiter if self.bulk_lane else None
+                if self.ssh.download_file(source_file, str(target_path), sftp=sftp, limiter=limiter):
                     logger.info(f"   Файл скачан: {target_path.name}")
                     # Сохраняем время скачивания файла для последующего удаления
-                    self.downloaded_files_times[str(target_path)] = datetime.now()
+                    self.downloaded_files_times.add(target_path, time.time())
                     return target_path
                 else:
+                    # Удаляем зарезервированный пустой файл
+                    try:
+                        target_path.unlink()
+                    except OSError:
+                        pass
                     return None
             else:
-                # Копируем локально
-                shutil.copy2(source_file, target_path)
-                logger.info(f"   Файл скопирован: {target_path.name}")
+                # Копируем локально (по возможности без копирования данных)
+                while True:
+                    try:
+                        strategy = materialize_file(source_file, target_path)
+                        break
+                    except FileExistsError:
+                        # Файл с этим именем появился после выбора имени - берем следующее
+                        target_path = self._target_path_for(target_filename)
+                self.materialize_stats[strategy] = self.materialize_stats.get(strategy, 0) + 1
+                logger.info(f"   Файл скопирован: {target_path.name} (способ: {strategy})")
                 
                 # Сохраняем время скачивания файла для последующего удаления
-                self.downloaded_files_times[str(target_path)] = datetime.now()
+                self.downloaded_files_times.add(target_path, time.time())
                 
                 return target_path
         except Exception as e:
             logger.error(f"❌ Ошибка при копировании файла {source_file}: {e}")
             return None
     
-    def close_excel_file(self, file_path, delay_seconds=7):
+    def close_excel_file(self, file_path, delay_seconds=7, trace_id=None):
         """Закрытие Excel файла через заданное время"""
         def close_after_delay():
             time.sleep(delay_seconds)
@@ -423,12 +1625,13 @@ class DBOOperatorAutomation:
                     # Пытаемся использовать COM объект Excel (если доступен)
                     if WIN32COM_AVAILABLE:
                         try:
-                            excel = win32com.client.GetActiveObject("Excel.Application")
+                            excel = _load_win32com().client.GetActiveObject("Excel.Application")
                             for workbook in excel.Workbooks:
                                 try:
                                     if workbook.FullName.lower() == str(file_path.resolve()).lower():
                                         workbook.Close(SaveChanges=False)
                                         logger.info(f"✓ .xlsm файл закрыт: {file_path.name}")
+                                        self.trace(trace_id, 'closed')
                                         return
                                 except:
                                     continue
@@ -444,6 +1647,7 @@ class DBOOperatorAutomation:
                             timeout=5
                         )
                         logger.info(f"✓ Excel закрыт: {file_path.name}")
+                        self.trace(trace_id, 'closed')
                     except Exception as e:
                         logger.warning(f"⚠ Не удалось закрыть Excel: {file_path.name} ({e})")
                 else:
@@ -456,6 +1660,7 @@ class DBOOperatorAutomation:
                             timeout=5
                         )
                         logger.info(f"✓ .xlsm файл закрыт: {file_path.name}")
+                        self.trace(trace_id, 'closed')
                     except Exception as e:
                         logger.warning(f"⚠ Не удалось закрыть файл: {file_path.name} ({e})")
             except Exception as e:
@@ -465,7 +1670,7 @@ class DBOOperatorAutomation:
         thread = threading.Thread(target=close_after_delay, daemon=True)
         thread.start()
     
-    def open_excel_file(self, file_path, close_delay=7):
+    def open_excel_file(self, file_path, close_delay=7, trace_id=None):
         """Открытие .xlsm файла для запуска VBA макросов через батник"""
         try:
             if not file_path.exists():
@@ -524,9 +1729,10 @@ class DBOOperatorAutomation:
             
             logger.info(f"✓ .xlsm файл открыт: {file_path.name}")
             logger.info(f"   ⏰ Автоматическое закрытие через {close_delay} сек...")
+            self.trace(trace_id, 'launched')
             
             # Запускаем автоматическое закрытие
-            self.close_excel_file(file_path, close_delay)
+            self.close_excel_file(file_path, close_delay, trace_id=trace_id)
             
             return True
             
@@ -555,6 +1761,8 @@ class DBOOperatorAutomation:
             logger.info(f"   Вложений: {len(attachments)}")
             
             downloaded_files = []
+            remote_jobs = []
+            tar_items = OrderedDict()  # {saved_as: original_filename} для пакетного скачивания
             
             for attachment_info in attachments:
                 saved_as = attachment_info.get('saved_as')
@@ -564,47 +1772,200 @@ class DBOOperatorAutomation:
                     continue
                 
                 if self.use_ssh:
-                    source_file = f"{self.remote_dir}/{saved_as}"
-                    is_remote = True
-                else:
-                    source_file = self.container_dir / saved_as
-                    is_remote = False
-                
-                # Проверяем существование файла
-                if is_remote:
-                    # Для удаленных файлов проверяем через SSH
-                    try:
-                        self.ssh.sftp.stat(f"{self.remote_dir}/{saved_as}")
-                    except:
-                        logger.warning(f"   ⚠ Файл не найден на удаленном сервере: {saved_as}")
-                        continue
-                else:
-                    if not source_file.exists():
-                        logger.warning(f"   ⚠ Файл не найден: {saved_as}")
+                    if BULK_TAR_ENABLED and saved_as not in tar_items:
+                        tar_items[saved_as] = original_filename
                         continue
+                    # Проверка существования и скачивание - в массовой полосе
+                    remote_jobs.append(functools.partial(
+                        self._download_remote_attachment,
+                        remote_path=f"{self.remote_dir}/{saved_as}",
+                        saved_as=saved_as,
+                        original_filename=original_filename
+                    ))
+                    continue
+                
+                source_file = self.container_dir / saved_as
+                
+                # Проверяем по снимку директории, сделанному в этой проверке
+                if not self.snapshot.exists(saved_as):
+                    logger.warning(f"   ⚠ Файл не найден: {saved_as}")
+                    continue
                 
                 logger.info(f"📎 Копирование вложения: {original_filename}")
                 
-                target_path = self.copy_attachment(source_file, original_filename, is_remote=is_remote)
+                target_path = self.copy_attachment(source_file, original_filename)
                 if target_path:
                     downloaded_files.append(target_path)
             
+            if len(tar_items) >= BULK_TAR_MIN_FILES:
+                remote_jobs.append(functools.partial(
+                    self._download_remote_attachments_tar,
+                    email_key=metadata_file_info['path'],
+                    items=tar_items,
+                    on_done=lambda files: self._finish_email(metadata_file_info, files, auto_open=auto_open)
+                ))
+            else:
+                remote_jobs.extend(
+                    functools.partial(
+                        self._download_remote_attachment,
+                        remote_path=f"{self.remote_dir}/{saved_as}",
+                        saved_as=saved_as,
+                        original_filename=original_filename
+                    )
+                    for saved_as, original_filename in tar_items.items()
+                )
+            
+            if remote_jobs:
+                # Опрос не ждет скачивания: письмо будет завершено массовой полосой
+                self._in_flight.add(metadata_file_info['path'])
+                self.bulk_lane.submit(
+                    metadata_file_info['path'], remote_jobs,
+                    lambda files: self._finish_email(metadata_file_info, files, auto_open=auto_open)
+                )
+                return
+            
+            self._finish_email(metadata_file_info, downloaded_files, auto_open=auto_open)
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка при обработке письма {metadata_file_info.get('name', 'unknown')}: {e}")
+    
+    def _download_remote_attachment(self, sftp, remote_path, saved_as, original_filename):
+        """Задание массовой полосы: проверка и скачивание одного вложения"""
+        try:
+            sftp.stat(remote_path)
+        except Exception:
+            logger.warning(f"   ⚠ Файл не найден на удаленном сервере: {saved_as}")
+            return None
+        
+        logger.info(f"📎 Копирование вложения: {original_filename}")
+        return self.copy_attachment(remote_path, original_filename, is_remote=True, sftp=sftp)
+    
+    def _download_remote_attachments_tar(self, sftp, email_key, items, on_done):
+        """Задание массовой полосы: скачивание вложений письма одним tar-потоком
+
+        Архив распаковывается на лету в директорию загрузки по тем же правилам
+        именования, что и в copy_attachment. Вложения, не полученные из архива
+        (нет файла, ошибка tar, обрыв потока), ставятся в массовую полосу
+        на скачивание по одному через SFTP.
+        """
+        remaining = dict(items)
+        downloaded = []
+        limiter = self.bulk_lane.limiter
+        command = "cd {} && tar -c{}f - -- {}".format(
+            shlex.quote(self.remote_dir),
+            'z' if BULK_TAR_COMPRESS else '',
+            " ".join(shlex.quote(name) for name in items)
+        )
+        
+        logger.info(f"📦 Пакетное скачивание вложений: {len(items)} файл(ов)")
+        try:
+            stdout, stderr = self.ssh.exec_stream(command)
+            try:
+                with tarfile.open(fileobj=stdout, mode='r|gz' if BULK_TAR_COMPRESS else 'r|') as archive:
+                    for member in archive:
+                        # Принимаем только запрошенные файлы - имена из архива не используются как пути
+                        if not member.isfile() or member.name not in remaining:
+                            continue
+                        original_filename = remaining[member.name]
+                        target_path = self._target_path_for(original_filename, reserve=True)
+                        try:
+                            source = archive.extractfile(member)
+                            with open(target_path, 'wb') as target:
+                                while True:
+                                    chunk = source.read(32768)
+                                    if not chunk:
+                                        break
+                                    limiter.consume(len(chunk))
+                                    target.write(chunk)
+                        except Exception:
+                            target_path.unlink()
+                            raise
+                        del remaining[member.name]
+                        logger.info(f"   Файл скачан (пакетом): {target_path.name}")
+                        self.downloaded_files_times.add(target_path, time.time())
+                        downloaded.append(target_path)
+            
+                exit_status = stdout.channel.recv_exit_status()
+                if exit_status != 0 and remaining:
+                    error_text = stderr.read().decode('utf-8', 'replace').strip()
+                    logger.warning(f"   ⚠ tar завершился с кодом {exit_status}: {error_text[:200]}")
+            finally:
+                # Закрываем exec-канал и при ошибке распаковки: иначе удаленный tar
+                # ждет освобождения окна канала, а канал остается на общем транспорте
+                stdout.channel.close()
+        except Exception as e:
+            logger.warning(f"   ⚠ Ошибка пакетного скачивания, переход на SFTP: {e}")
+        
+        if remaining:
+            logger.info(f"   Скачивание по одному через SFTP: {len(remaining)} файл(ов)")
+            self.bulk_lane.submit(email_key, [
+                functools.partial(
+                    self._download_remote_attachment,
+                    remote_path=f"{self.remote_dir}/{saved_as}",
+                    saved_as=saved_as,
+                    original_filename=original_filename
+                )
+                for saved_as, original_filename in remaining.items()
+            ], on_done)
+        return downloaded
+    
+    def mark_processed(self, file_key, mtime):
+        """Пометка файла метаданных как обработанного с записью в журнал на диске"""
+        with self._journal_lock:
+            self.processed_files.add(file_key, mtime)
+            if not self.journal_file:
+                return
+            try:
+                self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.journal_file, 'a', encoding='utf-8') as f:
+                    f.write(f"{mtime!r}\t{file_key}\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logger.warning(f"⚠ Не удалось записать журнал обработанных писем: {e}")
+    
+    def _replay_journal(self):
+        """Добавление в индекс писем из журнала (обработанных после сохранения состояния)"""
+        if not self.journal_file or not self.journal_file.exists():
+            return 0
+        replayed = 0
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # Недописанная строка - сбой во время записи
+                mtime, _, file_key = line[:-1].partition('\t')
+                try:
+                    mtime = float(mtime)
+                except ValueError:
+                    continue
+                if file_key and not self.processed_files.is_stale(mtime):
+                    self.processed_files.add(file_key, mtime)
+                    replayed += 1
+        return replayed
+    
+    def _finish_email(self, metadata_file_info, downloaded_files, auto_open=True):
+        """Завершение обработки письма: открытие .xlsm и пометка как обработанного"""
+        try:
             if downloaded_files:
-                logger.info(f"✓ Скачано файлов: {len(downloaded_files)}")
+                logger.info(f"✓ Скачано файлов: {len(downloaded_files)} ({metadata_file_info['name']})")
+                # Одно событие на письмо - после последнего вложения
+                self.trace(metadata_file_info['name'], 'downloaded')
+                
+                # Помечаем метаданные как обработанные до открытия .xlsm: после сбоя
+                # и перезапуска макросы письма не запустятся второй раз
+                self.mark_processed(metadata_file_info['path'], metadata_file_info['mtime'].timestamp())
                 
                 if auto_open:
                     for file_path in downloaded_files:
                         if file_path.suffix.lower() == '.xlsm':
-                            self.open_excel_file(file_path, close_delay=EXCEL_CLOSE_DELAY)
-                
-                # Помечаем метаданные как обработанные
-                file_key = metadata_file_info['path']
-                self.processed_files.add(file_key)
+                            self.open_excel_file(file_path, close_delay=EXCEL_CLOSE_DELAY,
+                                                 trace_id=metadata_file_info['name'])
             else:
-                logger.info("   Вложений не найдено")
-            
+                logger.info(f"   Вложений не найдено ({metadata_file_info['name']})")
         except Exception as e:
             logger.error(f"❌ Ошибка при обработке письма {metadata_file_info.get('name', 'unknown')}: {e}")
+        finally:
+            self._in_flight.discard(metadata_file_info['path'])
     
     def process_file_directly(self, file_path, auto_open=True):
         """Обработка файла напрямую без метаданных"""
@@ -629,33 +1990,49 @@ class DBOOperatorAutomation:
     def cleanup_old_files(self, lifetime_minutes=10):
         """Удаление файлов, скачанных более указанного времени назад"""
         try:
-            current_time = datetime.now()
-            files_to_delete = []
+            current_time = time.time()
+            cutoff = current_time - lifetime_minutes * 60
+            deleted_count = 0
             
-            # Проверяем все отслеживаемые файлы
-            for file_path_str, download_time in list(self.downloaded_files_times.items()):
-                file_path = Path(file_path_str)
-                age_minutes = (current_time - download_time).total_seconds() / 60
+            # Записи идут в порядке скачивания - извлекаем только устаревшие
+            for record in self.downloaded_files_times.pop_expired(cutoff):
+                file_path = Path(record.path)
+                age_minutes = (current_time - record.time) / 60
+                
+                if not file_path.exists():
+                    continue  # Файл уже удален (например, вручную)
                 
-                if age_minutes >= lifetime_minutes:
-                    if file_path.exists():
-                        files_to_delete.append((file_path, age_minutes))
-            
-            # Удаляем старые файлы
-            for file_path, age_minutes in files_to_delete:
                 try:
                     file_path.unlink()
-                    del self.downloaded_files_times[str(file_path)]
+                    deleted_count += 1
                     logger.info(f"🗑️  Удален старый файл: {file_path.name} (возраст: {age_minutes:.1f} мин)")
                 except Exception as e:
                     logger.warning(f"⚠ Не удалось удалить файл {file_path.name}: {e}")
+                    # Повторим попытку при следующей очистке
+                    self.downloaded_files_times.requeue(record)
             
-            if files_to_delete:
-                logger.info(f"✓ Удалено старых файлов: {len(files_to_delete)}")
+            if deleted_count:
+                logger.info(f"✓ Удалено старых файлов: {deleted_count}")
             
         except Exception as e:
             logger.error(f"❌ Ошибка при очистке старых файлов: {e}")
     
+    def log_materialize_stats(self):
+        """Вывод статистики способов получения вложений"""
+        if self.materialize_stats:
+            stats = ", ".join(f"{name}={count}" for name, count in sorted(self.materialize_stats.items()))
+            logger.info(f"📊 Способы копирования вложений: {stats}")
+    
+    def prune_processed_index(self, retention_minutes=60):
+        """Сдвиг водяной метки и удаление старых ключей из индекса обработанных файлов"""
+        try:
+            watermark = time.time() - retention_minutes * 60
+            removed = self.processed_files.prune(watermark)
+            if removed:
+                logger.debug(f"   Из индекса обработанных файлов удалено ключей: {removed} (осталось: {len(self.processed_files)})")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при очистке индекса обработанных файлов: {e}")
+    
     def process_new_emails(self, auto_open=True):
         """Обработка новых писем"""
         try:
@@ -667,39 +2044,63 @@ class DBOOperatorAutomation:
                 logger.debug(f"   Проверка удаленной директории: {self.remote_dir}")
             else:
                 logger.debug(f"   Проверка директории: {self.container_dir}")
-                if self.container_dir:
+                if self.container_dir and logger.isEnabledFor(logging.DEBUG):
                     logger.debug(f"   Абсолютный путь: {self.container_dir.resolve()}")
             
-            metadata_files = self.get_new_metadata_files()
-            
-            if not metadata_files:
-                # Показываем более детальную информацию
-                if self.use_ssh:
-                    all_files_info = self.ssh.list_files(self.remote_dir)
-                    all_files = [f['name'] for f in all_files_info]
-                    json_files = [f for f in all_files if f.endswith('_metadata.json')]
-                    other_files = [f for f in all_files if not f.endswith('_metadata.json')]
-                else:
-                    all_files = list(self.container_dir.iterdir()) if self.container_dir and self.container_dir.exists() else []
-                    json_files = [f.name for f in all_files if f.suffix == '.json' and f.name.endswith('_metadata.json')]
-                    other_files = [f.name for f in all_files if not f.name.endswith('_metadata.json')]
-                
-                if all_files:
-                    logger.info(f"📭 Новых писем с метаданными нет")
-                    logger.info(f"   Найдено: {len(json_files)} файлов метаданных, {len(other_files)} других файлов")
-                    
-                    if json_files:
-                        logger.info(f"   JSON файлы метаданных: {json_files[:3]}")
-                        logger.info(f"   Возможно, все файлы уже обработаны")
-                else:
-                    logger.info("📭 Новых писем нет (директория пуста)")
-                return
+            # Сначала - письма, поставленные в очередь через управляющий порт
+            handled_names = set()
+            for metadata_file in self._take_enqueued_metadata_files():
+                handled_names.add(metadata_file['name'])
+                self.process_email_metadata(metadata_file, auto_open=auto_open)
             
-            logger.info(f"📬 Найдено новых писем: {len(metadata_files)}")
+            if self.use_ssh:
+                # Удаленная директория читается потоково в фоне: обработка
+                # начинается с первых найденных писем, не дожидаясь конца листинга
+                metadata_files = stream_in_background(self._iter_remote_metadata_files)
+            else:
+                metadata_files = self.get_new_metadata_files()
             
+            new_count = 0
             for metadata_file in metadata_files:
+                if metadata_file['name'] in handled_names:
+                    continue
+                new_count += 1
                 self.process_email_metadata(metadata_file, auto_open=auto_open)
             
+            if new_count:
+                logger.info(f"📬 Обработано новых писем: {new_count}")
+                return
+            if handled_names:
+                return
+            
+            # Новых писем нет - показываем более детальную информацию
+            if self.use_ssh:
+                total_count = self.listing_stats['total']
+                json_count = self.listing_stats['metadata']
+                json_examples = self.listing_stats['metadata_examples']
+                other_count = total_count - json_count
+                if other_count and not json_count:
+                    logger.warning(f"   ⚠ Найдены файлы без метаданных: {other_count} файл(ов)")
+                    logger.info(f"   Убедитесь, что контейнер создает файлы *_metadata.json")
+            else:
+                # Используем снимок, сделанный в get_new_metadata_files
+                total_count = len(self.snapshot) if self.snapshot is not None else 0
+                json_examples = sorted(self.snapshot.entries)[:3] if self.snapshot is not None else []
+                json_count = len(self.snapshot.entries) if self.snapshot is not None else 0
+                other_count = total_count - json_count
+            
+            if total_count:
+                logger.info(f"📭 Новых писем с метаданными нет")
+                logger.info(f"   Найдено: {json_count} файлов метаданных, {other_count} других файлов")
+                
+                if json_count:
+                    logger.info(f"   JSON файлы метаданных: {json_examples}")
+                    logger.info(f"   Возможно, все файлы уже обработаны")
+                if self._in_flight:
+                    logger.info(f"   Скачиваются вложения писем: {len(self._in_flight)}")
+            else:
+                logger.info("📭 Новых писем нет (директория пуста)")
+            
         except Exception as e:
             logger.error(f"❌ Ошибка при обработке писем: {e}")
             import traceback
@@ -713,6 +2114,15 @@ class DBOOperatorAutomation:
         logger.info("=" * 60)
         logger.info("")
         
+        # SSH подключение устанавливается параллельно с восстановлением состояния
+        connect_thread = None
+        if self.use_ssh and not self.ssh.is_connected:
+            connect_thread = threading.Thread(target=self.ssh.connect, daemon=True)
+            connect_thread.start()
+        self.restore_state()
+        if connect_thread:
+            connect_thread.join()
+        
         if not self.check_container_directory():
             logger.error("❌ Не удалось подключиться к директории с файлами. Завершение работы.")
             if self.use_ssh:
@@ -727,27 +2137,46 @@ class DBOOperatorAutomation:
                 logger.info("   3. Путь к директории правильный")
             return
         
+        self.start_control_server()
+        
         try:
-            cleanup_interval_minutes = FILE_LIFETIME_MINUTES
             last_cleanup_time = datetime.now()
+            last_state_save = time.monotonic()
             
-            while True:
+            while not self._stop.is_set():
                 logger.info(f"\n{'=' * 60}")
                 logger.info(f"Проверка файлов: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
                 logger.info(f"{'=' * 60}")
                 
+                # Сигналы, пришедшие до этого момента, учтены этой проверкой
+                self._wake.clear()
                 self.process_new_emails(auto_open=auto_open)
+                self.poll_count += 1
+                self.last_poll_time = datetime.now()
+                
+                if self.time_to_first_poll is None:
+                    self.time_to_first_poll = round(time.perf_counter() - PROCESS_START, 3)
+                    logger.info(f"⏱ Время от запуска до первой проверки: {self.time_to_first_poll:.3f} сек")
                 
-                # Периодически очищаем старые файлы (каждые 5 минут или после скачивания)
+                if self.state_file and time.monotonic() - last_state_save >= STATE_SAVE_INTERVAL:
+                    self.save_state()
+                    last_state_save = time.monotonic()
+                
+                # Периодически очищаем старые файлы (каждые 5 минут)
                 current_time = datetime.now()
                 time_since_cleanup = (current_time - last_cleanup_time).total_seconds() / 60
                 
-                if time_since_cleanup >= 5:  # Проверяем каждые 5 минут
-                    self.cleanup_old_files(lifetime_minutes=FILE_LIFETIME_MINUTES)
+                if time_since_cleanup >= self.cleanup_interval_minutes:
+                    self.cleanup_old_files(lifetime_minutes=self.file_lifetime_minutes)
+                    self.prune_processed_index(retention_minutes=self.processed_retention_minutes)
+                    self.log_materialize_stats()
                     last_cleanup_time = current_time
                 
                 logger.info(f"\nОжидание {check_interval} сек до следующей проверки...")
-                time.sleep(check_interval)
+                # Ожидание прерывается командой управляющего порта
+                if self._wake.wait(check_interval) and not self._stop.is_set():
+                    self._settle_wake()
+                    logger.info("⚡ Внеочередная проверка по сигналу управляющего порта")
                 
         except KeyboardInterrupt:
             logger.info("\n\nОстановка по запросу пользователя (Ctrl+C)")
@@ -755,15 +2184,459 @@ class DBOOperatorAutomation:
             logger.error(f"\n❌ Критическая ошибка: {e}")
             raise
         finally:
+            self.stop_control_server()
+            if self.bulk_lane:
+                self.bulk_lane.stop()
+            self.save_state()
             if self.use_ssh and self.ssh:
                 self.ssh.disconnect()
+            if self.tracer:
+                self.tracer.close()
+
+# ============================================================================
+# ДЛИТЕЛЬНЫЙ ПРОГОН (SOAK) И ПРОФИЛИРОВАНИЕ
+# ============================================================================
+
+def count_open_files():
+    """Количество открытых файлов (дескрипторов) процесса; None - не удалось определить"""
+    if os.path.isdir('/proc/self/fd'):
+        try:
+            return len(os.listdir('/proc/self/fd')) - 1  # Без дескриптора самого листинга
+        except OSError:
+            pass
+    if PSUTIL_AVAILABLE:
+        import psutil
+        process = psutil.Process()
+        try:
+            if platform.system() == "Windows":
+                return process.num_handles()
+            return process.num_fds()
+        except (psutil.Error, AttributeError):
+            pass
+    return None
+
+
+def count_sftp_channels(ssh):
+    """Количество открытых SSH-каналов (SFTP и exec) транспорта; None - не удалось определить"""
+    if ssh is None or ssh.client is None:
+        return None
+    transport = ssh.client.get_transport()
+    if transport is None:
+        return 0
+    try:
+        # Внутренний ChannelMap paramiko - публичного счетчика каналов нет
+        return len(transport._channels.values())
+    except Exception:
+        return None
+
+
+class SoakProfiler:
+    """Периодический сбор показателей процесса при длительной работе
+
+    Каждая выборка записывается одной JSON-строкой в ротируемый файл. Если показатель
+    растет на протяжении окна из SOAK_TREND_WINDOW выборок (наклон по методу наименьших
+    квадратов больше порога), в лог выводится предупреждение.
+    """
+
+    # Минимальный рост за окно, при котором выводится предупреждение
+    TREND_THRESHOLDS = {
+        'traced_memory_kb': 2048,
+        'threads': 5,
+        'open_files': 20,
+        'sftp_channels': 4,
+        'processed_keys': 500,
+        'downloaded_files': 500,
+        'emails_downloading': 50,
+    }
+
+    def __init__(self, automation, log_file=SOAK_LOG_FILE, interval=SOAK_SAMPLE_INTERVAL,
+                 top_n=SOAK_TOP_ALLOCATORS, window=SOAK_TREND_WINDOW):
+        """Инициализация профилировщика"""
+        self.automation = automation
+        self.log_file = Path(log_file)
+        self.interval = interval
+        self.top_n = top_n
+        self.window = window
+        self.samples_taken = 0
+        self.warnings = 0
+        self.last_sample = None
+        self._history = {name: deque(maxlen=window) for name in self.TREND_THRESHOLDS}
+        self._baseline = None
+        self._started_tracemalloc = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._handler = None
+        self._file_logger = logging.getLogger('dbo_automation.soak')
+        self._file_logger.propagate = False
+        self._file_logger.setLevel(logging.INFO)
+
+    def start(self):
+        """Запуск tracemalloc и потока выборок"""
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        self._handler = logging.handlers.RotatingFileHandler(
+            self.log_file, maxBytes=SOAK_LOG_MAX_BYTES, backupCount=SOAK_LOG_BACKUP_COUNT, encoding='utf-8')
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._file_logger.addHandler(self._handler)
+        
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            self._started_tracemalloc = True
+        self._baseline = self._take_snapshot()
+        self.automation.profiler = self
+        
+        self._thread = threading.Thread(target=self._run, name="soak-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"🩺 Профилирование длительного прогона: выборка каждые {self.interval:g} сек -> {self.log_file}")
+        return self
+
+    def stop(self):
+        """Последняя выборка и остановка профилировщика"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.sample()
+        self._file_logger.removeHandler(self._handler)
+        self._handler.close()
+        self._baseline = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _run(self):
+        """Цикл выборок"""
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"⚠ Ошибка выборки показателей: {e}")
+
+    def _take_snapshot(self):
+        """Снимок tracemalloc без выделений самого tracemalloc и импорта модулей"""
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    @staticmethod
+    def _where(statistic):
+        """Место выделения памяти в виде файл:строка"""
+        frame = statistic.traceback[0]
+        return f"{os.path.basename(frame.filename)}:{frame.lineno}"
+
+    def sample(self):
+        """Одна выборка показателей: запись в файл и проверка роста"""
+        automation = self.automation
+        current, peak = tracemalloc.get_traced_memory()
+        record = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'traced_memory_kb': round(current / 1024, 1),
+            'traced_peak_kb': round(peak / 1024, 1),
+            'threads': threading.active_count(),
+            'open_files': count_open_files(),
+            'sftp_channels': count_sftp_channels(automation.ssh) if automation.use_ssh else None,
+            'processed_keys': len(automation.processed_files),
+            'downloaded_files': len(automation.downloaded_files_times),
+            'emails_downloading': len(automation._in_flight),
+            'poll_count': automation.poll_count,
+        }
+        
+        if tracemalloc.is_tracing():
+            snapshot = self._take_snapshot()
+            record['top'] = [
+                {'where': self._where(statistic), 'size_kb': round(statistic.size / 1024, 1),
+                 'count': statistic.count}
+                for statistic in snapshot.statistics('lineno')[:self.top_n]
+            ]
+            if self._baseline is not None:
+                record['growth'] = [
+                    {'where': self._where(statistic), 'size_diff_kb': round(statistic.size_diff / 1024, 1),
+                     'count_diff': statistic.count_diff}
+                    for statistic in snapshot.compare_to(self._baseline, 'lineno')[:self.top_n]
+                    if statistic.size_diff > 0
+                ]
+        
+        record['warnings'] = self._check_trends(record)
+        self.samples_taken += 1
+        self.last_sample = record
+        self._file_logger.info(json.dumps(record, ensure_ascii=False))
+        logger.debug(f"🩺 Память: {record['traced_memory_kb']} КБ, потоков: {record['threads']}, "
+                     f"файлов: {record['open_files']}, SFTP-каналов: {record['sftp_channels']}, "
+                     f"ключей: {record['processed_keys']}")
+        return record
+
+    def _check_trends(self, record):
+        """Оценка роста показателей по окну выборок; возвращает список выросших показателей"""
+        now = time.monotonic()
+        grown = []
+        for name, threshold in self.TREND_THRESHOLDS.items():
+            value = record.get(name)
+            if value is None:
+                continue
+            history = self._history[name]
+            history.append((now, value))
+            if len(history) < self.window:
+                continue
+            
+            # Наклон по методу наименьших квадратов, рост - за время окна
+            t0 = history[0][0]
+            xs = [t - t0 for t, _ in history]
+            ys = [v for _, v in history]
+            mean_x = sum(xs) / len(xs)
+            mean_y = sum(ys) / len(ys)
+            denominator = sum((x - mean_x) ** 2 for x in xs)
+            if not denominator:
+                continue
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / denominator
+            growth = slope * xs[-1]
+            
+            if growth >= threshold and ys[-1] > ys[0]:
+                grown.append(name)
+                self.warnings += 1
+                logger.warning(f"📈 Рост показателя {name}: {ys[0]} -> {ys[-1]} за {len(history)} выборок "
+                               f"(~{slope * 3600:.1f} в час)")
+                history.clear()  # Следующее предупреждение - не раньше, чем через окно
+        return grown
+
+    def last_sample_summary(self):
+        """Краткие показатели последней выборки для команды STATUS"""
+        if not self.last_sample:
+            return {'samples': self.samples_taken, 'warnings': self.warnings}
+        summary = {name: self.last_sample.get(name) for name in self.TREND_THRESHOLDS}
+        summary.update(samples=self.samples_taken, warnings=self.warnings)
+        return summary
+
+
+class SyntheticMailGenerator:
+    """Генератор синтетических писем (метаданные + вложения) в локальной директории
+
+    Вложения записываются до файла метаданных, файл метаданных появляется атомарно.
+    Файлы старше max_age_seconds удаляются, как при ротации на сервере.
+    """
+
+    def __init__(self, directory, emails_per_second, max_age_seconds, attachment_size=4096):
+        """Инициализация генератора"""
+        self.directory = Path(directory)
+        self.emails_per_second = emails_per_second
+        self.max_age_seconds = max_age_seconds
+        self.attachment_size = attachment_size
+        self.generated = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Запуск потока генерации"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="synthetic-mail", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Остановка генерации"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        """Равномерная генерация писем с заданной интенсивностью"""
+        interval = 1.0 / self.emails_per_second
+        next_time = time.monotonic()
+        last_rotation = next_time
+        while not self._stop.wait(max(0.0, next_time - time.monotonic())):
+            try:
+                self._write_email()
+            except OSError as e:
+                logger.warning(f"⚠ Ошибка генерации синтетического письма: {e}")
+            now = time.monotonic()
+            next_time += interval
+            if next_time < now - 1:
+                next_time = now  # Не догоняем отставание пачкой писем
+            if now - last_rotation >= 1:
+                self._rotate()
+                last_rotation = now
+
+    def _write_email(self):
+        """Запись одного письма"""
+        number = self.generated
+        prefix = f"synthetic_{number:08d}"
+        attachments = []
+        for i in range(random.randint(1, 4)):
+            extension = ".xlsm" if i == 0 else random.choice((".pdf", ".docx", ".xlsm"))
+            saved_as = f"{prefix}_{i}{extension}"
+            (self.directory / saved_as).write_bytes(b"\0" * self.attachment_size)
+            attachments.append({'filename': f"Документ_{number}_{i}{extension}", 'saved_as': saved_as})
+        
+        metadata = {
+            'type': 'synthetic',
+            'from': 'soak@example.local',
+            'subject': f"Синтетическое письмо {number}",
+            'company': 'Soak Test',
+            'attachments': attachments,
+        }
+        temp_path = self.directory / f".{prefix}.tmp"
+        temp_path.write_text(json.dumps(metadata, ensure_ascii=False), encoding='utf-8')
+        os.replace(temp_path, self.directory / f"{prefix}_metadata.json")
+        self.generated += 1
+
+    def _rotate(self):
+        """Удаление старых синтетических файлов"""
+        cutoff = time.time() - self.max_age_seconds
+        with os.scandir(self.directory) as iterator:
+            for entry in iterator:
+                if not entry.name.startswith("synthetic_"):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
+def run_soak_synthetic(directory, minutes, speed=SOAK_SPEED, emails_per_hour=SOAK_EMAILS_PER_HOUR,
+                       log_file=SOAK_LOG_FILE):
+    """Синтетический длительный прогон в локальном режиме с ускоренным временем"""
+    base = Path(directory)
+    container_dir = base / "container"
+    container_dir.mkdir(parents=True, exist_ok=True)
+    emails_per_second = emails_per_hour * speed / 3600
+    
+    print("=" * 60)
+    print("СИНТЕТИЧЕСКИЙ ДЛИТЕЛЬНЫЙ ПРОГОН")
+    print("=" * 60)
+    print(f"Директория: {base}")
+    print(f"Длительность: {minutes:g} мин, ускорение: x{speed:g} (~{minutes * speed / 60:.1f} ч трафика)")
+    print(f"Писем в секунду: {emails_per_second:.2f}")
+    print(f"Показатели: {log_file}")
+    print("=" * 60)
+    
+    automation = DBOOperatorAutomation(
+        container_dir=container_dir,
+        download_dir=base / "downloads",
+        use_ssh=False,
+        trace_file=base / "email_trace.tsv" if TRACE_ENABLED else None
+    )
+    # Интервалы обслуживания сокращаются вместе со временем
+    automation.cleanup_interval_minutes /= speed
+    automation.file_lifetime_minutes /= speed
+    automation.processed_retention_minutes /= speed
+    
+    generator = SyntheticMailGenerator(container_dir, emails_per_second,
+                                       max_age_seconds=2 * PROCESSED_RETENTION_MINUTES * 60 / speed)
+    profiler = SoakProfiler(automation, log_file, interval=max(1.0, SOAK_SAMPLE_INTERVAL / speed))
+    worker = threading.Thread(
+        target=automation.run_continuous,
+        kwargs={'check_interval': max(0.05, CHECK_INTERVAL / speed), 'auto_open': False},
+        daemon=True
+    )
+    
+    # Подробный лог каждого письма при такой интенсивности не читается
+    previous_level = logger.level
+    logger.setLevel(logging.WARNING)
+    started = time.monotonic()
+    deadline = started + minutes * 60
+    try:
+        profiler.start()
+        generator.start()
+        worker.start()
+        while time.monotonic() < deadline and worker.is_alive():
+            time.sleep(min(10.0, max(0.0, deadline - time.monotonic())))
+            summary = profiler.last_sample_summary()
+            simulated_hours = (time.monotonic() - started) * speed / 3600
+            print(f"🩺 {simulated_hours:5.1f} ч: писем {generator.generated}, проверок {automation.poll_count}, "
+                  f"память {summary.get('traced_memory_kb')} КБ, потоков {summary.get('threads')}, "
+                  f"файлов {summary.get('open_files')}, ключей {summary.get('processed_keys')}, "
+                  f"предупреждений {summary['warnings']}")
+    except KeyboardInterrupt:
+        print("\n\nОстановка по запросу пользователя (Ctrl+C)")
+    finally:
+        generator.stop()
+        automation.stop()
+        worker.join(timeout=30)
+        profiler.stop()
+        logger.setLevel(previous_level)
+    
+    print("=" * 60)
+    print(f"Писем создано: {generator.generated}, проверок: {automation.poll_count}")
+    print(f"Выборок: {profiler.samples_taken}, предупреждений о росте: {profiler.warnings}")
+    print(f"Показатели: {profiler.log_file}")
+    print("=" * 60)
+    return profiler.warnings
 
 # ============================================================================
 # ГЛАВНАЯ ФУНКЦИЯ
 # ============================================================================
 
+def print_container_inventory(container_path):
+    """Вывод содержимого директории контейнера"""
+    try:
+        with os.scandir(container_path) as iterator:
+            names = [entry.name for entry in iterator]
+    except OSError as e:
+        print(f"⚠ Не удалось прочитать директорию контейнера: {e}")
+        return
+    
+    if names:
+        json_files = [name for name in names if name.endswith('_metadata.json')]
+        other_files = [name for name in names if not name.endswith('_metadata.json')]
+        print(f"   Найдено файлов в директории: {len(names)}")
+        print(f"   - Файлов метаданных: {len(json_files)}")
+        print(f"   - Других файлов: {len(other_files)}")
+        if json_files:
+            print(f"   Примеры метаданных: {json_files[:3]}")
+        if other_files:
+            print(f"   Примеры других файлов: {other_files[:3]}")
+    else:
+        print(f"   Директория пуста")
+
+
+def parse_args(argv=None):
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Автоматизация оператора ДБО")
+    parser.add_argument('--trace-report', action='store_true',
+                        help="вывести отчет по задержкам обработки писем (p50/p95/p99) и выйти")
+    parser.add_argument('--trace-file', default=TRACE_FILE,
+                        help=f"файл трассировки (по умолчанию: {TRACE_FILE})")
+    parser.add_argument('--control', nargs='+', metavar='КОМАНДА',
+                        help="отправить команду запущенной автоматизации (POLL, ENQUEUE <файл>, STATUS) и выйти")
+    parser.add_argument('--soak', action='store_true',
+                        help="длительный прогон: периодически записывать показатели памяти, потоков, "
+                             "файлов и SFTP-каналов и предупреждать об их росте")
+    parser.add_argument('--soak-synthetic', metavar='DIR',
+                        help="синтетический прогон в локальном режиме: генерировать письма в DIR "
+                             "с ускоренным временем и собирать показатели, затем выйти")
+    parser.add_argument('--soak-minutes', type=float, default=6,
+                        help="длительность синтетического прогона в минутах (по умолчанию: 6)")
+    parser.add_argument('--soak-speed', type=float, default=SOAK_SPEED,
+                        help=f"ускорение времени синтетического прогона (по умолчанию: {SOAK_SPEED})")
+    parser.add_argument('--soak-rate', type=float, default=SOAK_EMAILS_PER_HOUR,
+                        help=f"писем в час без учета ускорения (по умолчанию: {SOAK_EMAILS_PER_HOUR})")
+    parser.add_argument('--soak-log', default=SOAK_LOG_FILE,
+                        help=f"ротируемый файл показателей (по умолчанию: {SOAK_LOG_FILE})")
+    return parser.parse_args(argv)
+
+
 def main():
     """Запуск автоматизации"""
+    args = parse_args()
+    
+    if args.trace_report:
+        print_trace_report(args.trace_file)
+        return
+    
+    if args.control:
+        try:
+            print(send_control_command(" ".join(args.control)))
+        except OSError as e:
+            print(f"❌ Нет связи с управляющим портом {CONTROL_HOST}:{CONTROL_PORT}: {e}")
+        return
+    
+    if args.soak_synthetic:
+        run_soak_synthetic(args.soak_synthetic, args.soak_minutes, speed=args.soak_speed,
+                           emails_per_hour=args.soak_rate, log_file=args.soak_log)
+        return
     
     print("=" * 60)
     print("АВТОМАТИЗАЦИЯ ОПЕРАТОРА ДБО")
@@ -808,20 +2681,11 @@ def main():
             print(f"✓ Директория создана: {container_path}")
         else:
             print(f"✓ Директория контейнера найдена: {container_path}")
-            # Показываем содержимое
-            files = list(container_path.iterdir())
-            if files:
-                print(f"   Найдено файлов в директории: {len(files)}")
-                json_files = [f for f in files if f.name.endswith('_metadata.json')]
-                other_files = [f for f in files if not f.name.endswith('_metadata.json')]
-                print(f"   - Файлов метаданных: {len(json_files)}")
-                print(f"   - Других файлов: {len(other_files)}")
-                if json_files:
-                    print(f"   Примеры метаданных: {[f.name for f in json_files[:3]]}")
-                if other_files:
-                    print(f"   Примеры других файлов: {[f.name for f in other_files[:3]]}")
-            else:
-                print(f"   Директория пуста")
+            # Показываем содержимое (в большой директории это долго - по умолчанию в фоне)
+            if STARTUP_INVENTORY == "full":
+                print_container_inventory(container_path)
+            elif STARTUP_INVENTORY == "background":
+                threading.Thread(target=print_container_inventory, args=(container_path,), daemon=True).start()
         print()
     else:
         print(f"📁 Подключение к удаленному серверу через SSH...")
@@ -843,16 +2707,24 @@ def main():
             ssh_user=SSH_USER,
             ssh_password=SSH_PASSWORD,
             ssh_port=SSH_PORT,
-            remote_dir=REMOTE_ATTACHMENTS_DIR
+            remote_dir=REMOTE_ATTACHMENTS_DIR,
+            trace_file=args.trace_file if TRACE_ENABLED else None,
+            control_port=CONTROL_PORT if CONTROL_ENABLED else None,
+            state_file=STATE_FILE if STATE_ENABLED else None
         )
     else:
         automation = DBOOperatorAutomation(
             container_dir=CONTAINER_ATTACHMENTS_DIR,
             download_dir=DOWNLOAD_DIR,
             process_all=PROCESS_ALL_FILES,
-            use_ssh=False
+            use_ssh=False,
+            trace_file=args.trace_file if TRACE_ENABLED else None,
+            control_port=CONTROL_PORT if CONTROL_ENABLED else None,
+            state_file=STATE_FILE if STATE_ENABLED else None
         )
     
+    profiler = SoakProfiler(automation, args.soak_log).start() if args.soak else None
+    
     # Запускаем непрерывную проверку
     try:
         automation.run_continuous(
@@ -870,6 +2742,9 @@ def main():
         print(error_msg)
         logger.critical(f"Критическая ошибка: {e}", exc_info=True)
         raise
+    finally:
+        if profiler:
+            profiler.stop()
 
 
 if __name__ == "__main__":